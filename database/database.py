@@ -24,6 +24,8 @@ if DATABASE_URL:
         pool_timeout=30,           # Wait up to 30 seconds for a connection
         pool_recycle=1800,         # Recycle connections older than 30 minutes
         pool_pre_ping=True,        # Verify connections are still active before using
+        pool_use_lifo=True,        # Reuse the most recently returned (warm) connection first
+        query_cache_size=1200,     # Compiled statement cache (default 500) so ORM queries skip recompilation
         # Use proper psycopg2 keepalive parameters
         connect_args={
             "keepalives": 1,              # Enable keepalives
@@ -39,7 +41,8 @@ else:
     logger.warning("No DATABASE_URL found, defaulting to SQLite")
     engine = create_engine(
         "sqlite:///./database.db",
-        connect_args={"check_same_thread": False}
+        connect_args={"check_same_thread": False},
+        query_cache_size=1200
     )
 
 # Create a configured "Session" class
@@ -56,6 +59,23 @@ def get_db():
     finally:
         db.close()
 
+class SessionScope:
+    """
+    Context manager for short-lived sessions opened outside of FastAPI
+    dependency injection. The session is closed even if the block raises.
+
+    Usage:
+        with SessionScope() as db:
+            ...
+    """
+    def __enter__(self):
+        self.db = SessionLocal()
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.close()
+        return False
+
 # Utility function to get connection status
 def get_db_pool_status():
     """Get current database connection pool status"""
@@ -1,9 +1,24 @@
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime
+from typing import Dict
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Pending last_active timestamps keyed by user id, written out in batches
+# by flush_last_active() instead of one UPDATE + COMMIT per request
+LAST_ACTIVE_FLUSH_INTERVAL_SECONDS = 5
+_last_active_buffer: Dict[int, datetime] = {}
+
+# popular_characters_mv ranks characters per language for the page-numbered
+# popular list; it is refreshed in the background and only read once a
+# refresh (or existence check) in this process has succeeded
+POPULAR_VIEW_REFRESH_INTERVAL_SECONDS = 300
+POPULAR_VIEW_LOCK_KEY = 7142001
+_popular_view_ready = False
+
 def increment_counter(db, table, user_id, counter_field, amount=1):
     """
     Atomically increment a counter without using the read-modify-write pattern.
@@ -108,3 +123,150 @@ def attach_to_conversation(db, user_id, conversation_id):
     """)
     
     db.execute(sql, {"user_id": user_id, "conversation_id": conversation_id})
+
+def record_last_active(user_id: int) -> None:
+    """
+    Queue a last_active update for a user. The newest timestamp per user wins
+    and is persisted by the next flush.
+    """
+    _last_active_buffer[user_id] = datetime.utcnow()
+
+def _take_last_active() -> Dict[int, datetime]:
+    """Swap out the pending buffer so requests keep queueing while we write"""
+    global _last_active_buffer
+    pending, _last_active_buffer = _last_active_buffer, {}
+    return pending
+
+def _write_last_active(db, pending: Dict[int, datetime]) -> int:
+    """Persist a batch of last_active timestamps in a single statement"""
+    if not pending:
+        return 0
+    
+    # Sorted by id so concurrent workers lock user rows in the same order
+    rows = [{"id": user_id, "ts": pending[user_id]} for user_id in sorted(pending)]
+    
+    try:
+        if db.bind.dialect.name == "postgresql":
+            # Ship the whole batch as two array parameters: one round-trip and a
+            # fixed statement text regardless of batch size (no bind-param limit)
+            db.execute(text("""
+                UPDATE users SET last_active = v.ts
+                FROM unnest(CAST(:ids AS INTEGER[]), CAST(:timestamps AS TIMESTAMP[])) AS v(id, ts)
+                WHERE users.id = v.id
+            """), {
+                "ids": [row["id"] for row in rows],
+                "timestamps": [row["ts"] for row in rows]
+            })
+        else:
+            db.execute(text("UPDATE users SET last_active = :ts WHERE id = :id"), rows)
+        db.commit()
+        return len(rows)
+    except SQLAlchemyError as e:
+        db.rollback()
+        # Put the timestamps back unless a newer one was queued meanwhile
+        for user_id, ts in pending.items():
+            _last_active_buffer.setdefault(user_id, ts)
+        logger.error(f"last_active flush failed: {str(e)}")
+        return 0
+
+def flush_last_active(db) -> int:
+    """
+    Write all queued last_active timestamps in a single statement.
+    
+    Args:
+        db: SQLAlchemy session
+    
+    Returns:
+        Number of users updated
+    """
+    return _write_last_active(db, _take_last_active())
+
+async def last_active_flush_loop(interval: float = LAST_ACTIVE_FLUSH_INTERVAL_SECONDS):
+    """Background task that periodically flushes queued last_active updates"""
+    from database.database import SessionLocal
+    
+    def _write(pending):
+        db = SessionLocal()
+        try:
+            return _write_last_active(db, pending)
+        finally:
+            db.close()
+    
+    while True:
+        await asyncio.sleep(interval)
+        if _last_active_buffer:
+            # Take the batch on the event loop thread, write it off the loop
+            await asyncio.to_thread(_write, _take_last_active())
+
+def is_popular_view_ready() -> bool:
+    """Whether popular_characters_mv can be queried from this process"""
+    return _popular_view_ready
+
+def popular_view_exists(db) -> bool:
+    """Whether popular_characters_mv has been created (it only exists on PostgreSQL)"""
+    if db.bind.dialect.name != "postgresql":
+        return False
+    return bool(db.execute(text("SELECT to_regclass('popular_characters_mv') IS NOT NULL")).scalar())
+
+def refresh_popular_characters(db) -> bool:
+    """
+    Refresh popular_characters_mv. Only one worker refreshes per interval;
+    the others just confirm the view exists.
+    
+    Args:
+        db: SQLAlchemy session
+    
+    Returns:
+        Whether the view is usable
+    """
+    global _popular_view_ready
+    if db.bind.dialect.name != "postgresql":
+        return False
+    
+    try:
+        acquired = db.execute(
+            text("SELECT pg_try_advisory_xact_lock(:key)"),
+            {"key": POPULAR_VIEW_LOCK_KEY}
+        ).scalar()
+        if acquired:
+            # CONCURRENTLY keeps the view readable while it is rebuilt
+            db.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY popular_characters_mv"))
+            ready = True
+        else:
+            ready = db.execute(text("SELECT to_regclass('popular_characters_mv') IS NOT NULL")).scalar()
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"popular_characters_mv refresh failed: {str(e)}")
+        ready = False
+    
+    _popular_view_ready = bool(ready)
+    return _popular_view_ready
+
+async def popular_characters_refresh_loop(interval: float = POPULAR_VIEW_REFRESH_INTERVAL_SECONDS):
+    """
+    Background task that periodically refreshes popular_characters_mv.
+    Stops (logging once) if the view doesn't exist, e.g. on SQLite or before
+    migrations/popular_characters_view.py has been run.
+    """
+    from database.database import SessionLocal
+    
+    def _refresh():
+        db = SessionLocal()
+        try:
+            if not popular_view_exists(db):
+                return None
+            return refresh_popular_characters(db)
+        except SQLAlchemyError as e:
+            # Transient (e.g. the database is unreachable); try again next interval
+            db.rollback()
+            logger.error(f"popular_characters_mv refresh failed: {str(e)}")
+            return False
+        finally:
+            db.close()
+    
+    while True:
+        if await asyncio.to_thread(_refresh) is None:
+            logger.warning("popular_characters_mv not found (it needs PostgreSQL and migrations/popular_characters_view.py); page-numbered popular lists use OFFSET and the view is not refreshed")
+            return
+        await asyncio.sleep(interval)
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, DateTime, Float, Text, JSON, Boolean
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, DateTime, Float, Text, JSON, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -8,7 +8,9 @@ user_conversations = Table(
     'user_conversations',
     Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('conversation_id', Integer, ForeignKey('conversations.id'))
+    Column('conversation_id', Integer, ForeignKey('conversations.id')),
+    # Access-check EXISTS probe; also the conflict target of attach_to_conversation
+    Index('ix_user_conversations_conversation_user', 'conversation_id', 'user_id', unique=True)
 )
 
 class Message(Base):
@@ -22,12 +24,17 @@ class Message(Base):
     
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        # Newest-first history reads and max(id) lookups per conversation
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+    )
+
 class Conversation(Base):
     __tablename__ = "conversations"
     
     id = Column(Integer, primary_key=True, index=True)
     character_id = Column(Integer, ForeignKey('characters.id'))
-    creator_id = Column(Integer, ForeignKey('users.id'))
+    creator_id = Column(Integer, ForeignKey('users.id'), index=True)
     system_message = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -49,7 +56,7 @@ class Character(Base):
     greeting = Column(Text, nullable=False)  # Character's initial greeting message
     tagline = Column(String)
     photo_url = Column(String)
-    creator_id = Column(Integer, ForeignKey('users.id'))
+    creator_id = Column(Integer, ForeignKey('users.id'), index=True)
     num_chats_created = Column(Integer, default=0)
     num_messages = Column(Integer, default=0)  # Combined sent/received
     rating = Column(Float, default=0.0)
@@ -62,6 +69,15 @@ class Character(Base):
     creator = relationship("User", back_populates="created_characters")
     conversations = relationship("Conversation", back_populates="character")
 
+    __table_args__ = (
+        # Keyset pagination for the popular list: WHERE language = ? AND (num_messages, id) < (?, ?)
+        Index("ix_characters_language_popularity", "language", num_messages.desc(), id.desc()),
+        # Keyset pagination for a creator's characters, newest first
+        Index("ix_characters_creator_recent", "creator_id", "language", created_at.desc(), id.desc()),
+        # Ordered walk for search results paged on (name, id)
+        Index("ix_characters_language_name", "language", "name", "id"),
+    )
+
 class User(Base):
     __tablename__ = "users"
     
@@ -69,8 +85,8 @@ class User(Base):
     world_id = Column(String, unique=True, index=True)  # World ID nullifier hash
     username = Column(String, unique=True, index=True, nullable=True)  # Optional
     email = Column(String, unique=True, index=True, nullable=True)    # Optional
-    language = Column(String, default="en")  # Default language
-    credits = Column(Integer, default=100)
+    language = Column(String, default="en", server_default="en", nullable=False)  # Default language
+    credits = Column(Integer, default=100, server_default="100", nullable=False)
     character_messages_received = Column(Integer, default=0)  # Counter for messages sent to user's created characters
     wallet_address = Column(String, unique=True, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -89,6 +105,11 @@ class User(Base):
     sessions = relationship("Session", back_populates="user")
     token_redemptions = relationship("TokenRedemption", back_populates="user")
 
+    __table_args__ = (
+        # Language distribution stats (GROUP BY language as an index-only scan)
+        Index("ix_users_language", "language"),
+    )
+
 class Session(Base):
     __tablename__ = "sessions"
     
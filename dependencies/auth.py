@@ -4,15 +4,28 @@ from sqlalchemy.orm import Session
 from typing import Optional
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-import json
+import orjson
 import logging
-from database.database import get_db, SessionLocal
+import functools
+from database.database import get_db
 from database.models import User, WorldIDVerification, Session as DbSession
+from database.db_utils import record_last_active
 from web3 import Web3
 import secrets
 
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=65_536)
+def checksum_address(address: str) -> Optional[str]:
+    """
+    Validate a wallet address and return its checksum form, or None if invalid.
+    Checksumming hashes the address with keccak256, so results are memoized;
+    the raw input is the key so mixed-case addresses keep their checksum check.
+    """
+    if not Web3.is_address(address):
+        return None
+    return Web3.to_checksum_address(address)
+
 class WorldIDCredentials(BaseModel):
     nullifier_hash: str
     merkle_root: str
@@ -67,47 +80,36 @@ async def get_current_user(
     3. Wallet address in X-Wallet-Address header
     4. World ID credentials in X-WorldID-Credentials header (legacy)
     """
-    logger.info("Auth headers: %s", dict(request.headers) if request else {})
-    
     # First try session token
     token = session_token or session_token_query
     if token:
         session = get_session(token, db)
         
         if session:
-            logger.info(f"Found valid session for user {session.user_id}")
+            logger.debug("Found valid session for user %s", session.user_id)
             # Get user from database
             user = session.user
             if user:
-                # Update last active
-                user.last_active = datetime.utcnow()
-                db.commit()
+                # Queue last active for the batched flush
+                record_last_active(user.id)
                 return user
             else:
-                logger.error(f"No user found for session user_id {session.user_id}")
-        else:
-            logger.info("No valid session token provided")
+                logger.error("No user found for session user_id %s", session.user_id)
     
     if credentials:
         token = credentials.credentials
-        logger.info(f"Trying session token: {token[:8]}...")
         session = get_session(token, db)
         
         if session:
-            logger.info(f"Found valid session for user {session.user_id}")
+            logger.debug("Found valid session for user %s", session.user_id)
             # Get user from database
             user = session.user
             if user:
-                # Update last active
-                user.last_active = datetime.utcnow()
-                db.commit()
+                # Queue last active for the batched flush
+                record_last_active(user.id)
                 return user
             else:
-                logger.error(f"No user found for session user_id {session.user_id}")
-        else:
-            logger.info("No valid session token provided")
-    else:
-        logger.info("No session token provided")
+                logger.error("No user found for session user_id %s", session.user_id)
     
     # If no request object, we can't check headers
     if not request:
@@ -121,17 +123,16 @@ async def get_current_user(
     wallet_address = request.headers.get('X-Wallet-Address')
     if wallet_address:
         try:
-            # Validate wallet address format
-            if not Web3.is_address(wallet_address):
-                logger.error(f"Invalid wallet address format: {wallet_address}")
+            # Validate wallet address format and convert to checksum address
+            checksum = checksum_address(wallet_address)
+            if checksum is None:
+                logger.error("Invalid wallet address format: %s", wallet_address)
                 raise HTTPException(
                     status_code=401,
                     detail="Invalid wallet address",
                     headers={"WWW-Authenticate": "Bearer"}
                 )
-                
-            # Convert to checksum address
-            wallet_address = Web3.to_checksum_address(wallet_address)
+            wallet_address = checksum
             
             # Get user by wallet address
             user = db.query(User).filter(
@@ -139,12 +140,11 @@ async def get_current_user(
             ).first()
             
             if user:
-                # Update last active
-                user.last_active = datetime.utcnow()
-                db.commit()
+                # Queue last active for the batched flush
+                record_last_active(user.id)
                 return user
             else:
-                logger.error(f"No user found with wallet address: {wallet_address}")
+                logger.error("No user found with wallet address: %s", wallet_address)
                 raise HTTPException(
                     status_code=401,
                     detail="User not found for wallet address",
@@ -152,7 +152,7 @@ async def get_current_user(
                 )
                 
         except Exception as e:
-            logger.error(f"Error verifying wallet address: {str(e)}")
+            logger.error("Error verifying wallet address: %s", e)
             raise HTTPException(
                 status_code=401,
                 detail="Invalid wallet address",
@@ -169,8 +169,8 @@ async def get_current_user(
         )
         
     try:
-        creds = json.loads(credentials)
-        logger.info(f"Received credentials for nullifier_hash: {creds['nullifier_hash']}")
+        creds = orjson.loads(credentials)
+        logger.debug("Received credentials for nullifier_hash: %s", creds['nullifier_hash'])
         
         # Check for existing verification
         verification = db.query(WorldIDVerification).filter(
@@ -196,14 +196,13 @@ async def get_current_user(
                 headers={"WWW-Authenticate": "Bearer"}
             )
             
-        # Update last active
-        user.last_active = datetime.utcnow()
-        db.commit()
+        # Queue last active for the batched flush
+        record_last_active(user.id)
             
         return user
         
     except Exception as e:
-        logger.error(f"Error verifying credentials: {str(e)}")
+        logger.error("Error verifying credentials: %s", e)
         raise HTTPException(
             status_code=401,
             detail="Invalid credentials",
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 import os
 from routes import (
     user_routes,
@@ -17,13 +17,19 @@ from routes import auth_routes  # New wallet auth routes
 from routes import transcription_routes  # New transcription routes
 from middleware import TimingMiddleware
 from database.init_db import init_db
+from database.database import SessionLocal
+from services.llm_service import close_llm_service
+from services.image_generation_service import close_image_generation_client
+from services.payment_service import close_payment_client
+from database.db_utils import last_active_flush_loop, flush_last_active, popular_characters_refresh_loop
+import asyncio
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="PersonaAI API")
+app = FastAPI(title="PersonaAI API", default_response_class=ORJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -44,6 +50,37 @@ async def get_accept_language(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# Batched last_active writes
+@app.on_event("startup")
+async def start_last_active_flush():
+    app.state.last_active_task = asyncio.create_task(last_active_flush_loop())
+
+# Periodic refresh of the popular characters ranking view
+@app.on_event("startup")
+async def start_popular_view_refresh():
+    app.state.popular_view_task = asyncio.create_task(popular_characters_refresh_loop())
+
+@app.on_event("shutdown")
+async def stop_popular_view_refresh():
+    app.state.popular_view_task.cancel()
+
+# Close the shared outbound HTTP clients' connection pools
+@app.on_event("shutdown")
+async def stop_http_clients():
+    await close_llm_service()
+    await close_image_generation_client()
+    await close_payment_client()
+
+@app.on_event("shutdown")
+async def stop_last_active_flush():
+    app.state.last_active_task.cancel()
+    # Persist whatever is still queued before the worker exits
+    db = SessionLocal()
+    try:
+        flush_last_active(db)
+    finally:
+        db.close()
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
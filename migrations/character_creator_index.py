@@ -0,0 +1,36 @@
+"""
+Migration script to index characters.creator_id for per-user character counts
+
+Usage: python migrations/character_creator_index.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def create_character_creator_index():
+    """Create the characters.creator_id index used by the user stats count"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        connection.execute(text(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_characters_creator_id '
+            'ON characters (creator_id)'
+        ))
+        print("Ensured index 'ix_characters_creator_id'")
+
+        print("Character creator index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_character_creator_index()
@@ -0,0 +1,46 @@
+"""
+Migration script to add the indexes backing keyset pagination of character lists
+
+Usage: python migrations/character_keyset_indexes.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+INDEXES = {
+    'ix_characters_language_popularity':
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_characters_language_popularity '
+        'ON characters (language, num_messages DESC, id DESC)',
+    'ix_characters_creator_recent':
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_characters_creator_recent '
+        'ON characters (creator_id, language, created_at DESC, id DESC)',
+    'ix_characters_language_name':
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_characters_language_name '
+        'ON characters (language, name, id)',
+}
+
+def create_character_keyset_indexes():
+    """Create the composite indexes used by the cursor-paginated character lists"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        for name, ddl in INDEXES.items():
+            connection.execute(text(ddl))
+            print(f"Ensured index '{name}'")
+
+        print("Character keyset index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_character_keyset_indexes()
@@ -0,0 +1,36 @@
+"""
+Migration script to index conversations.creator_id for the conversation list
+
+Usage: python migrations/conversation_creator_index.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def create_conversation_creator_index():
+    """Create the conversations.creator_id index used when listing a user's conversations"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        connection.execute(text(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversations_creator_id '
+            'ON conversations (creator_id)'
+        ))
+        print("Ensured index 'ix_conversations_creator_id'")
+
+        print("Conversation creator index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_conversation_creator_index()
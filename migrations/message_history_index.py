@@ -0,0 +1,36 @@
+"""
+Migration script to index messages by (conversation_id, id) for history reads
+
+Usage: python migrations/message_history_index.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def create_message_history_index():
+    """Create the (conversation_id, id) index used by the conversation history window"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        connection.execute(text(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_conversation_id_id '
+            'ON messages (conversation_id, id)'
+        ))
+        print("Ensured index 'ix_messages_conversation_id_id'")
+
+        print("Message history index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_message_history_index()
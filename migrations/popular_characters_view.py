@@ -0,0 +1,46 @@
+"""
+Migration script to create the materialized per-language popularity ranking
+read by the page-numbered popular characters list
+
+Usage: python migrations/popular_characters_view.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+STATEMENTS = {
+    'popular_characters_mv':
+        'CREATE MATERIALIZED VIEW IF NOT EXISTS popular_characters_mv AS '
+        'SELECT id, language, num_messages, '
+        'ROW_NUMBER() OVER (PARTITION BY language ORDER BY num_messages DESC, id DESC) AS rank '
+        'FROM characters',
+    # A unique index is required for REFRESH MATERIALIZED VIEW CONCURRENTLY
+    'ix_popular_characters_mv_language_rank':
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_popular_characters_mv_language_rank '
+        'ON popular_characters_mv (language, rank)',
+}
+
+def create_popular_characters_view():
+    """Create popular_characters_mv and the index it is queried and refreshed by"""
+
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        for name, ddl in STATEMENTS.items():
+            connection.execute(text(ddl))
+            print(f"Ensured '{name}'")
+
+        print("Popular characters view migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_popular_characters_view()
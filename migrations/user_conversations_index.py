@@ -0,0 +1,44 @@
+"""
+Migration script to add the unique (conversation_id, user_id) index on user_conversations
+
+Usage: python migrations/user_conversations_index.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def create_user_conversations_index():
+    """Remove duplicate participant rows, then create the unique index"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        # The association table has no key, so duplicates may exist; keep one of each
+        result = connection.execute(text(
+            'DELETE FROM user_conversations a USING user_conversations b '
+            'WHERE a.ctid > b.ctid '
+            'AND a.conversation_id = b.conversation_id AND a.user_id = b.user_id'
+        ))
+        print(f"Removed {result.rowcount} duplicate participant rows")
+
+        connection.execute(text(
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_user_conversations_conversation_user '
+            'ON user_conversations (conversation_id, user_id)'
+        ))
+        print("Ensured index 'ix_user_conversations_conversation_user'")
+
+        print("User conversations index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_user_conversations_index()
@@ -0,0 +1,36 @@
+"""
+Migration script to index users.language for the language distribution stats
+
+Usage: python migrations/user_language_index.py
+"""
+
+import sys
+import os
+from sqlalchemy import create_engine, text
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def create_user_language_index():
+    """Create the users.language index used by scripts/user_stats.py"""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    connection = engine.connect()
+
+    try:
+        connection.execute(text(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_language '
+            'ON users (language)'
+        ))
+        print("Ensured index 'ix_users_language'")
+
+        print("User language index migration completed successfully")
+
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    create_user_language_index()
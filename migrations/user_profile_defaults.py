@@ -0,0 +1,47 @@
+"""
+Migration script to backfill and enforce defaults for users.language and users.credits
+
+Usage: python migrations/user_profile_defaults.py
+"""
+
+import sys
+import os
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, text, String, Integer
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import DATABASE_URL
+
+def upgrade_user_defaults():
+    """Backfill NULL language/credits and add server defaults with NOT NULL"""
+    
+    # Connect to the database
+    engine = create_engine(DATABASE_URL)
+    connection = engine.connect()
+    
+    try:
+        with connection.begin():
+            # Create migration context
+            context = MigrationContext.configure(connection)
+            op = Operations(context)
+            
+            # Backfill with the values the API already reported for NULL rows
+            result = connection.execute(text("UPDATE users SET language = 'en' WHERE language IS NULL"))
+            print(f"Backfilled language for {result.rowcount} users")
+            result = connection.execute(text("UPDATE users SET credits = 0 WHERE credits IS NULL"))
+            print(f"Backfilled credits for {result.rowcount} users")
+            
+            op.alter_column('users', 'language', existing_type=String(), server_default='en', nullable=False)
+            op.alter_column('users', 'credits', existing_type=Integer(), server_default='100', nullable=False)
+            print("Set server defaults and NOT NULL on users.language and users.credits")
+        
+        print("User defaults migration completed successfully")
+        
+    finally:
+        connection.close()
+        
+if __name__ == "__main__":
+    upgrade_user_defaults()
@@ -1,24 +1,102 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, func, or_
-from typing import List, Optional, Dict, Any
+from sqlalchemy import desc, func, or_, and_, tuple_, table, column, update
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime
 from .base import BaseRepository
 from database.models import Character, User
 
 # try to force some rest
 
+# Materialized per-language popularity ranking, see migrations/popular_characters_view.py
+popular_characters_mv = table(
+    "popular_characters_mv",
+    column("id"),
+    column("language"),
+    column("rank")
+)
+
+def after_desc(sort_column, sort_value, character_id: int):
+    """
+    Keyset filter for rows after (sort_value, character_id) when ordering by
+    sort_column DESC NULLS FIRST, id DESC. A NULL sort value can't take part
+    in a row comparison, so it gets its own branch: the remaining NULL rows,
+    then every non-NULL one.
+    """
+    if sort_value is None:
+        return or_(
+            and_(sort_column.is_(None), Character.id < character_id),
+            sort_column.isnot(None)
+        )
+    return tuple_(sort_column, Character.id) < tuple_(sort_value, character_id)
+
 class CharacterRepository(BaseRepository[Character]):
     def __init__(self, db: Session):
         super().__init__(Character, db)
     
+    def get_by_id_and_language(self, character_id: int, language: str) -> Optional[Character]:
+        """Get a character by ID, only if it belongs to the given language"""
+        return self.db.query(Character)\
+            .filter(Character.id == character_id)\
+            .filter(Character.language == language)\
+            .first()
+    
+    def update_returning(self, character_id: int, values: Dict[str, Any]) -> Optional[Character]:
+        """
+        Update a character in a single UPDATE ... RETURNING round-trip.
+        Returns None if no character has that ID.
+        """
+        character = self.db.scalars(
+            update(Character)
+            .where(Character.id == character_id)
+            .values(**values)
+            .returning(Character)
+        ).one_or_none()
+        self.db.commit()
+        return character
+    
     def get_by_popularity(self, skip: int = 0, limit: int = 10, language: str = "en") -> List[Character]:
-        """Get characters ordered by number of messages"""
+        """Get characters ordered by number of messages (OFFSET pagination, prefer the keyset variant)"""
         return self.db.query(Character)\
             .filter(Character.language == language)\
-            .order_by(desc(Character.num_messages))\
+            .order_by(desc(Character.num_messages), desc(Character.id))\
             .offset(skip)\
             .limit(limit)\
             .all()
     
+    def get_by_popularity_rank(self, skip: int = 0, limit: int = 10, language: str = "en") -> List[Character]:
+        """
+        Get a page of popular characters by precomputed rank instead of OFFSET.
+        Ranks come from popular_characters_mv and lag by up to one refresh.
+        """
+        return self.db.query(Character)\
+            .join(popular_characters_mv, popular_characters_mv.c.id == Character.id)\
+            .filter(popular_characters_mv.c.language == language)\
+            .filter(popular_characters_mv.c.rank.between(skip + 1, skip + limit))\
+            .order_by(popular_characters_mv.c.rank)\
+            .all()
+    
+    def get_by_popularity_keyset(
+        self,
+        cursor: Optional[Tuple[Optional[int], int]] = None,
+        limit: int = 10,
+        language: str = "en"
+    ) -> List[Character]:
+        """
+        Get characters ordered by number of messages, starting after the
+        (num_messages, id) cursor of the previous page's last row
+        """
+        query = self.db.query(Character)\
+            .filter(Character.language == language)
+        if cursor is not None:
+            num_messages, character_id = cursor
+            query = query.filter(after_desc(Character.num_messages, num_messages, character_id))
+        # NULLS FIRST is PostgreSQL's default for DESC (and matches the index);
+        # spelled out so SQLite pages the same way
+        return query\
+            .order_by(desc(Character.num_messages).nullsfirst(), desc(Character.id))\
+            .limit(limit)\
+            .all()
+    
     def get_by_creator(self, creator_id: int, language: str = "en") -> List[Character]:
         """Get all characters created by a user"""
         return self.db.query(Character)\
@@ -26,6 +104,28 @@ class CharacterRepository(BaseRepository[Character]):
             .filter(Character.language == language)\
             .all()
     
+    def get_by_creator_keyset(
+        self,
+        creator_id: int,
+        cursor: Optional[Tuple[Optional[datetime], int]] = None,
+        limit: Optional[int] = None,
+        language: str = "en"
+    ) -> List[Character]:
+        """
+        Get a user's characters newest first, starting after the
+        (created_at, id) cursor of the previous page's last row
+        """
+        query = self.db.query(Character)\
+            .filter(Character.creator_id == creator_id)\
+            .filter(Character.language == language)
+        if cursor is not None:
+            created_at, character_id = cursor
+            query = query.filter(after_desc(Character.created_at, created_at, character_id))
+        query = query.order_by(desc(Character.created_at).nullsfirst(), desc(Character.id))
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+    
     def get_character_stats(self, character_id: int):
         character = self.get_by_id(character_id)
         if not character:
@@ -66,9 +166,38 @@ class CharacterRepository(BaseRepository[Character]):
                 )
             )\
             .filter(Character.language == language)\
+            .order_by(Character.name, Character.id)\
             .offset(skip)\
             .limit(limit)\
             .all()
+    
+    def search_keyset(
+        self,
+        query: str,
+        cursor: Optional[Tuple[str, int]] = None,
+        limit: int = 10,
+        language: str = "en"
+    ) -> List[Character]:
+        """
+        Search characters by name or description ordered by (name, id),
+        starting after the cursor of the previous page's last row
+        """
+        search = self.db.query(Character)\
+            .filter(
+                or_(
+                    Character.name.ilike(f"%{query}%"),
+                    Character.character_description.ilike(f"%{query}%"),
+                    Character.tagline.ilike(f"%{query}%")
+                )
+            )\
+            .filter(Character.language == language)
+        if cursor is not None:
+            name, character_id = cursor
+            search = search.filter(tuple_(Character.name, Character.id) > tuple_(name, character_id))
+        return search\
+            .order_by(Character.name, Character.id)\
+            .limit(limit)\
+            .all()
 
     def get_grouped_by_type(self, language: str = "en", limit_per_type: int = 10) -> Dict[str, List[Character]]:
         """Get characters grouped by their primary type"""
@@ -1,18 +1,107 @@
-from sqlalchemy.orm import Session, joinedload
-from typing import List, Optional
+from sqlalchemy.orm import Session, joinedload, defer
+from sqlalchemy import insert, update, delete, select, exists, func, bindparam, or_
+from typing import List, Optional, NamedTuple, Tuple
 from .base import BaseRepository
-from database.models import Conversation, Message, Character
+from database.models import Conversation, Message, Character, user_conversations
+from database.db_utils import increment_counter
 from datetime import datetime
 
+# Built once so every add_messages call reuses the same cached compiled statement.
+# A Core table insert skips the ORM unit of work; created_at still gets its
+# column default and comes back through RETURNING.
+INSERT_MESSAGE = insert(Message.__table__)\
+    .values(
+        conversation_id=bindparam("conversation_id"),
+        role=bindparam("role"),
+        content=bindparam("content")
+    )\
+    .returning(Message.__table__.c.id, Message.__table__.c.created_at, sort_by_parameter_order=True)
+
+class MessageRecord(NamedTuple):
+    """Plain result of add_messages; unlike an ORM instance it never expires on commit"""
+    id: int
+    conversation_id: int
+    role: str
+    content: str
+    created_at: datetime
+
+class TurnContext(NamedTuple):
+    """Everything a chat turn needs to read before calling the LLM"""
+    system_message: str
+    has_access: bool
+    character_creator_id: Optional[int]
+    latest_message_id: Optional[int]
+
+# Primary-key UPDATE for the final content of a streamed message (Core table
+# statement, so no ORM session synchronization is involved)
+UPDATE_MESSAGE_CONTENT = update(Message.__table__)\
+    .where(Message.__table__.c.id == bindparam("message_id"))\
+    .values(content=bindparam("content"))
+
 class ConversationRepository(BaseRepository[Conversation]):
     def __init__(self, db: Session):
         super().__init__(Conversation, db)
     
-    def get_messages(self, conversation_id: int) -> List[Message]:
-        conversation = self.get_by_id(conversation_id)
-        if not conversation:
-            return []
-        return conversation.messages
+    def get_messages(
+        self,
+        conversation_id: int,
+        limit: Optional[int] = None,
+        skip_first: bool = False
+    ) -> List[Message]:
+        """
+        Get a conversation's messages oldest first, straight from the messages
+        table. With a limit only the newest `limit` messages are read; with
+        skip_first the conversation's first message (the initial greeting) is
+        left out in SQL instead of being sliced off afterwards.
+        """
+        query = select(Message).where(Message.conversation_id == conversation_id)
+        if limit is None:
+            query = query.order_by(Message.id)
+            if skip_first:
+                query = query.offset(1)
+            return self.db.execute(query).scalars().all()
+        
+        # Newest first, one extra row when skipping: the oldest row fetched is then
+        # either the greeting or outside the limit, and is dropped either way
+        messages = self.db.execute(
+            query.order_by(Message.id.desc()).limit(limit + 1 if skip_first else limit)
+        ).scalars().all()
+        if skip_first:
+            messages = messages[:-1]
+        return messages[::-1]
+
+    def get_turn_context(self, conversation_id: int, user_id: int) -> Optional[TurnContext]:
+        """
+        Load the system message, the user's access, the character creator
+        and the newest message id for a chat turn in one round-trip.
+        Returns None if the conversation doesn't exist.
+        """
+        row = self.db.execute(
+            select(
+                Conversation.system_message,
+                or_(
+                    Conversation.creator_id == user_id,
+                    exists().where(
+                        user_conversations.c.conversation_id == Conversation.id,
+                        user_conversations.c.user_id == user_id
+                    )
+                ),
+                Character.creator_id,
+                select(func.max(Message.id)).where(Message.conversation_id == Conversation.id).scalar_subquery()
+            )
+            .outerjoin(Character, Character.id == Conversation.character_id)
+            .where(Conversation.id == conversation_id)
+        ).first()
+        return TurnContext(*row) if row else None
+    
+    def get_recent_messages(self, conversation_id: int, limit: int) -> List:
+        """Get the newest messages of a conversation as (id, role, content) rows, newest first"""
+        return self.db.execute(
+            select(Message.id, Message.role, Message.content)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+        ).all()
 
     def update_last_chatted_with(self, conversation_id: int) -> Optional[Conversation]:
         conversation = self.get_by_id(conversation_id)
@@ -23,25 +112,39 @@ class ConversationRepository(BaseRepository[Conversation]):
         self.db.refresh(conversation)
         return conversation
         
-    def add_message(self, conversation_id: int, role: str, content: str) -> Optional[Message]:
-        conversation = self.get_by_id(conversation_id)
+    def add_messages(self, conversation_id: int, messages: List[Tuple[str, str]]) -> Optional[List[MessageRecord]]:
+        """
+        Insert several (role, content) messages in one statement and commit.
+        Returns the records in the given order, or None if the conversation doesn't exist.
+        """
+        conversation = self.db.execute(
+            select(Conversation.character_id).where(Conversation.id == conversation_id)
+        ).first()
         if not conversation:
             return None
         
-        message = Message(
-            conversation_id=conversation_id,
-            role=role,
-            content=content
-        )
-        self.db.add(message)
+        # A single multi-row INSERT ... RETURNING hands back the generated
+        # columns, in parameter order, without a refresh SELECT
+        rows = self.db.execute(INSERT_MESSAGE, [
+            {"conversation_id": conversation_id, "role": role, "content": content}
+            for role, content in messages
+        ]).all()
         
-        # Update character message count if it's an assistant message
-        if role == "assistant" and conversation.character:
-            conversation.character.num_messages += 1
+        # Update character message count for assistant messages, atomically
+        # and without loading the character
+        assistant_count = sum(1 for role, _ in messages if role == "assistant")
+        if assistant_count and conversation.character_id:
+            increment_counter(self.db, "characters", conversation.character_id, "num_messages", assistant_count)
         
         self.db.commit()
-        self.db.refresh(message)
-        return message
+        return [
+            MessageRecord(message_id, conversation_id, role, content, created_at)
+            for (message_id, created_at), (role, content) in zip(rows, messages)
+        ]
+    
+    def add_message(self, conversation_id: int, role: str, content: str) -> Optional[MessageRecord]:
+        records = self.add_messages(conversation_id, [(role, content)])
+        return records[0] if records else None
     
     def get_by_participant(self, user_id: int) -> List[Conversation]:
         return self.db.query(Conversation)\
@@ -57,29 +160,76 @@ class ConversationRepository(BaseRepository[Conversation]):
             .all()
 
     def get_by_user_id_with_characters(self, user_id: int):
-        """Get all conversations for a user with character details included"""
+        """
+        Get all conversations for a user with character details included,
+        in one query. The list view never shows the system prompt (the
+        largest column) or participants, so neither is loaded.
+        """
         return self.db.query(Conversation)\
-            .options(joinedload(Conversation.character))\
+            .options(joinedload(Conversation.character), defer(Conversation.system_message))\
             .filter(Conversation.creator_id == user_id)\
             .order_by(Conversation.last_chatted_with.desc().nullsfirst(), Conversation.created_at.desc())\
             .all()
 
+    def finalize_message(self, conversation_id: int, message_id: int, content: str) -> None:
+        """
+        Write the final content of a streamed message and refresh its
+        conversation's preview and timestamp without loading either row.
+        The caller commits.
+        """
+        self.db.execute(UPDATE_MESSAGE_CONTENT, {"message_id": message_id, "content": content})
+        
+        # Create a preview from the content
+        preview = content[0:30] + "..." if len(content) > 30 else content
+        self.db.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .values(message_preview=preview, last_chatted_with=datetime.utcnow())
+        )
+
+    def delete_message(self, conversation_id: int, message_id: int) -> None:
+        """
+        Delete a message (e.g. the placeholder of a streamed reply that was
+        never finished) and take it back out of its character's message
+        count. The caller commits.
+        """
+        role = self.db.execute(
+            delete(Message.__table__)
+            .where(Message.__table__.c.id == message_id, Message.__table__.c.conversation_id == conversation_id)
+            .returning(Message.__table__.c.role)
+        ).scalar()
+        if role != "assistant":
+            return
+        
+        character_id = self.db.execute(
+            select(Conversation.character_id).where(Conversation.id == conversation_id)
+        ).scalar()
+        if character_id:
+            increment_counter(self.db, "characters", character_id, "num_messages", -1)
+
     def update_message(self, message_id: int, content: str) -> Optional[Message]:
-        """Update a message's content"""
-        message = self.db.query(Message).filter(Message.id == message_id).first()
+        """
+        Update a message's content and its conversation's preview with two
+        UPDATE statements, instead of loading both rows and writing ORM attributes
+        """
+        message = self.db.scalars(
+            update(Message)
+            .where(Message.id == message_id)
+            .values(content=content)
+            .returning(Message)
+        ).one_or_none()
         if not message:
             return None
-            
-        message.content = content
         
         # Create a preview from the content
         preview = content[0:30] + "..." if len(content) > 30 else content
         
         # Update the conversation's message preview
-        conversation = self.get_by_id(message.conversation_id)
-        if conversation:
-            conversation.message_preview = preview
+        self.db.execute(
+            update(Conversation)
+            .where(Conversation.id == message.conversation_id)
+            .values(message_preview=preview)
+        )
         
         self.db.commit()
-        self.db.refresh(message)
         return message
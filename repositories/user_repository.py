@@ -151,6 +151,19 @@ class UserRepository(BaseRepository[User]):
         self.db.refresh(user)
         return user
     
+    def try_consume_credit(self, user_id: int, amount: int = 1) -> Optional[int]:
+        """
+        Atomically deduct credits in a single UPDATE ... RETURNING.
+        Returns the remaining credits, or None if the user is missing or has
+        insufficient credits. The caller commits.
+        """
+        return self.db.execute(
+            update(User)
+            .where(User.id == user_id, User.credits >= amount)
+            .values(credits=User.credits - amount)
+            .returning(User.credits)
+        ).scalar_one_or_none()
+    
     def get_by_email(self, email: str) -> Optional[User]:
         """Get user by email"""
         return self.db.query(User).filter(User.email == email).first()
@@ -1545,12 +1545,12 @@ async def create_characters_batch(
                         
                         # Generate image
                         image_gen = ImageGenerationService()
-                        image_data = image_gen.generate_image(prompt=prompt)
+                        image_data = await image_gen.generate_image(prompt=prompt)
                         
                         if image_data:
                             # Upload to cloudinary
                             image_service = ImageService()
-                            url = image_service.upload_character_image(image_data, new_character.id)
+                            url = await image_service.upload_character_image(image_data, new_character.id)
                             
                             if url:
                                 # Update character
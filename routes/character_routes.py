@@ -1,8 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Request
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Request, Response, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional, Dict
-from pydantic import BaseModel
-from database.database import get_db, SessionLocal
+from pydantic import BaseModel, parse_obj_as
+from sqlalchemy import inspect
+from database.database import get_db, SessionScope
 from database.models import User, Character
 from services.character_service import CharacterService
 from services.image_service import ImageService
@@ -195,12 +196,10 @@ async def create_character(
         
         # STEP 1: Validate character data and perform moderation check
         # Use a single database session for initial validation and checks
-        db_validate = next(get_db())
+        with SessionScope() as db_validate:
+            character_model = None
+            character_data = None
         
-        character_model = None
-        character_data = None
-        
-        try:
             # Validate inputs
             service = CharacterService(db_validate)
             moderation_service = ModerationService()
@@ -219,9 +218,6 @@ async def create_character(
             }
             
             # We don't need to commit anything yet, just prepare the data
-        finally:
-            # Close the validation connection before external API calls
-            db_validate.close()
         
         # STEP 2: Perform moderation check without holding a DB connection
         # This is an external API call that could take time
@@ -237,59 +233,55 @@ async def create_character(
             raise ValueError(f"Character content violates content policy: {moderation_result.reason}")
 
         # STEP 3: Create the character in the database with all data
-        db_create = next(get_db())
-        try:
-            # Create a new service with the write connection
-            create_service = CharacterService(db_create)
+        with SessionScope() as db_create:
+            try:
+                # Create a new service with the write connection
+                create_service = CharacterService(db_create)
             
-            # Create character in a single transaction
-            character_model = create_service.create_character(
-                name=character_data["name"],
-                character_description=character_data["description"],
-                greeting=character_data["greeting"],
-                tagline=character_data["tagline"],
-                photo_url=character_data["photo_url"],
-                creator_id=character_data["creator_id"],
-                language=character_data["language"],
-                attributes=character_data["attributes"],
-                character_types=character_data["character_types"]
-            )
+                # Create character in a single transaction
+                character_model = create_service.create_character(
+                    name=character_data["name"],
+                    character_description=character_data["description"],
+                    greeting=character_data["greeting"],
+                    tagline=character_data["tagline"],
+                    photo_url=character_data["photo_url"],
+                    creator_id=character_data["creator_id"],
+                    language=character_data["language"],
+                    attributes=character_data["attributes"],
+                    character_types=character_data["character_types"]
+                )
             
-            # Note: System messages are generated and stored at conversation creation time
-            # not at character creation time
+                # Note: System messages are generated and stored at conversation creation time
+                # not at character creation time
             
-            # Make sure we access all the attributes we need before closing the session
-            # This prevents DetachedInstanceError when the model is serialized
-            character_response = {
-                "id": character_model.id,
-                "name": character_model.name,
-                "character_description": character_model.character_description,
-                "greeting": character_model.greeting,
-                "tagline": character_model.tagline,
-                "photo_url": character_model.photo_url,
-                "num_chats_created": character_model.num_chats_created,
-                "num_messages": character_model.num_messages,
-                "rating": character_model.rating,
-                "attributes": character_model.attributes,
-                "created_at": character_model.created_at.isoformat() if isinstance(character_model.created_at, datetime.datetime) else character_model.created_at,
-                "updated_at": character_model.updated_at.isoformat() if isinstance(character_model.updated_at, datetime.datetime) else character_model.updated_at,
-                "language": character_model.language,
-                "character_types": character_model.character_types
-            }
+                # Make sure we access all the attributes we need before closing the session
+                # This prevents DetachedInstanceError when the model is serialized
+                character_response = {
+                    "id": character_model.id,
+                    "name": character_model.name,
+                    "character_description": character_model.character_description,
+                    "greeting": character_model.greeting,
+                    "tagline": character_model.tagline,
+                    "photo_url": character_model.photo_url,
+                    "num_chats_created": character_model.num_chats_created,
+                    "num_messages": character_model.num_messages,
+                    "rating": character_model.rating,
+                    "attributes": character_model.attributes,
+                    "created_at": character_model.created_at.isoformat() if isinstance(character_model.created_at, datetime.datetime) else character_model.created_at,
+                    "updated_at": character_model.updated_at.isoformat() if isinstance(character_model.updated_at, datetime.datetime) else character_model.updated_at,
+                    "language": character_model.language,
+                    "character_types": character_model.character_types
+                }
             
-            # Commit all changes in one transaction
-            db_create.commit()
+                # Commit all changes in one transaction
+                db_create.commit()
             
-            # Convert the dictionary to a CharacterResponse instance
-            from pydantic import parse_obj_as
-            return parse_obj_as(CharacterResponse, character_response)
-        except Exception as db_error:
-            db_create.rollback()
-            logger.error(f"Database error creating character: {str(db_error)}")
-            raise db_error
-        finally:
-            # Ensure connection is closed
-            db_create.close()
+                # Convert the dictionary to a CharacterResponse instance
+                return parse_obj_as(CharacterResponse, character_response)
+            except Exception as db_error:
+                db_create.rollback()
+                logger.error(f"Database error creating character: {str(db_error)}")
+                raise db_error
     except ValueError as e:
         logger.error(f"Validation error creating character: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -300,18 +292,29 @@ async def create_character(
 @router.get("/list/popular", response_model=List[CharacterResponse])
 async def get_popular_characters(
     request: Request,
-    page: int = 1,
-    per_page: int = 10,
+    response: Response,
+    cursor: Optional[str] = None,
+    page: Optional[int] = None,
+    per_page: int = Query(10, ge=1, le=100),
     language: str = '',
     db: Session = Depends(get_db)
 ):
-    """Get list of popular characters with pagination"""
+    """
+    Get list of popular characters with cursor pagination.
+    The cursor for the next page is returned in the X-Next-Cursor header;
+    page is deprecated and only honoured when no cursor is passed.
+    """
     try:
         service = CharacterService(db)
         # Get language from request header
         language = request.headers.get("accept-language", "en").split(",")[0].split("-")[0].lower()
-        logger.info(f"Getting popular characters for language: {language}, page: {page}, per_page: {per_page}")
-        return service.get_popular_characters(language=language, page=page, per_page=per_page)
+        logger.info("Getting popular characters for language: %s, cursor: %s, page: %s, per_page: %s", language, cursor, page, per_page)
+        result = service.get_popular_characters(cursor=cursor, per_page=per_page, language=language, page=page)
+        if result["next_cursor"]:
+            response.headers["X-Next-Cursor"] = result["next_cursor"]
+        return result["data"]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting popular characters: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -365,7 +368,7 @@ async def upload_character_image(
         
         # Upload image
         image_service = ImageService()
-        url = image_service.upload_character_image(contents, character_id)
+        url = await image_service.upload_character_image(contents, character_id)
         if not url:
             raise HTTPException(status_code=400, detail="Failed to upload image")
             
@@ -392,7 +395,7 @@ async def generate_character_image(
     try:
         # Generate image
         image_gen = ImageGenerationService()
-        image_data = image_gen.generate_image(
+        image_data = await image_gen.generate_image(
             prompt=request.prompt,
             width=request.width,
             height=request.height,
@@ -404,7 +407,7 @@ async def generate_character_image(
             
         # Upload to cloudinary
         image_service = ImageService()
-        url = image_service.upload_character_image(image_data, character_id)
+        url = await image_service.upload_character_image(image_data, character_id)
         if not url:
             raise HTTPException(status_code=400, detail="Failed to upload generated image")
             
@@ -424,9 +427,16 @@ async def generate_character_image(
 async def get_creator_characters(
     world_id: str,
     request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    per_page: Optional[int] = Query(None, ge=1, le=100),
     db: Session = Depends(get_db)
 ):
-    """Get all characters created by a user with their stats"""
+    """
+    Get characters created by a user with their stats, newest first.
+    All of them are returned unless per_page is given, in which case the
+    cursor for the next page is returned in the X-Next-Cursor header.
+    """
     try:
         # First get the user by world_id
         user = db.query(User).filter(User.world_id == world_id).first()
@@ -436,7 +446,10 @@ async def get_creator_characters(
         service = CharacterService(db)
         # Get language from request header
         language = request.headers.get("accept-language", "en").split(",")[0].split("-")[0].lower()
-        characters = service.get_creator_characters(user.id, language=language)
+        result = service.get_creator_characters(user.id, language=language, cursor=cursor, per_page=per_page)
+        characters = result["data"]
+        if result["next_cursor"]:
+            response.headers["X-Next-Cursor"] = result["next_cursor"]
         
         # Get stats for each character
         characters_with_stats = []
@@ -455,6 +468,8 @@ async def get_creator_characters(
             })
             
         return characters_with_stats
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting creator's characters: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -462,19 +477,31 @@ async def get_creator_characters(
 @router.get("/search/", response_model=List[CharacterResponse])
 async def search_characters(
     request: Request,
+    response: Response,
     query: str = '',
-    page: int = 1,
-    per_page: int = 10,
+    cursor: Optional[str] = None,
+    page: Optional[int] = None,
+    per_page: int = Query(10, ge=1, le=100),
     db: Session = Depends(get_db)
 ):
-    """Search characters by name, tagline, or description"""
-    logger.info(f"Searching characters with query: {query}")
+    """
+    Search characters by name, tagline, or description.
+    The cursor for the next page is returned in the X-Next-Cursor header;
+    page is deprecated and only honoured when no cursor is passed.
+    """
+    logger.info("Searching characters with query: %s", query)
     try:
         character_service = CharacterService(db)
         # Get language from request header
         language = request.headers.get("accept-language", "en").split(",")[0].split("-")[0].lower()
-        characters = character_service.search_characters(query.strip(), page, per_page, language=language)
-        return characters
+        result = character_service.search_characters(
+            query.strip(), cursor=cursor, per_page=per_page, language=language, page=page
+        )
+        if result["next_cursor"]:
+            response.headers["X-Next-Cursor"] = result["next_cursor"]
+        return result["data"]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error searching characters: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to search characters")
@@ -532,7 +559,6 @@ async def diagnose(db: Session = Depends(get_db)):
     # Get pool status if possible
     pool_stats = {}
     try:
-        from sqlalchemy import inspect
         inspector = inspect(db.bind)
         if hasattr(inspector, 'pool'):
             pool = inspector.pool
@@ -2,10 +2,10 @@ from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from pydantic import BaseModel
-from database.database import get_db, SessionLocal
+from database.database import get_db, SessionScope
 from database.models import User, Message
-from services.conversation_service import ConversationService
-from services.llm_service import LLMService
+from services.conversation_service import ConversationService, remember_message
+from services.llm_service import get_llm_service
 from dependencies.auth import get_current_user
 from .character_routes import CharacterResponse
 from database.db_utils import batch_update, increment_counter, deduct_user_credits
@@ -18,12 +18,6 @@ from sse_starlette.sse import EventSourceResponse
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Simple class for detached messages (avoids ORM dependency)
-class DetachedMessage:
-    def __init__(self, role, content):
-        self.role = role
-        self.content = content
-
 router = APIRouter(tags=["conversations"])
 
 class ConversationCreate(BaseModel):
@@ -88,126 +82,107 @@ async def send_message(
         message_content = message.content
         
         # STEP 1: Comprehensive database session for preparation
-        db_read = next(get_db())
-        
-        conversation = None
-        character_creator_id = None
-        system_message = None
-        detached_history = []
-        user_message_id = None
+        with SessionScope() as db_read:
+            character_creator_id = None
+            system_message = None
+            detached_history = []
         
-        try:
-            # Get conversation with all needed data in a single query
-            service = ConversationService(db_read)
-            conversation = service.repository.get_by_id(conversation_id)
+            try:
+                # Get conversation, access and character creator in a single query
+                service = ConversationService(db_read)
+                context = service.repository.get_turn_context(conversation_id, user_id)
             
-            if not conversation:
-                raise ValueError("Conversation not found")
+                if not context:
+                    raise ValueError("Conversation not found")
                 
-            if conversation.creator_id != user_id and user_id not in [p.id for p in conversation.participants]:
-                raise ValueError("User does not have access to this conversation")
+                if not context.has_access:
+                    raise ValueError("User does not have access to this conversation")
             
-            # Store character creator ID for later counter increment
-            character_creator_id = conversation.character.creator_id
+                # Store character creator ID for later counter increment
+                character_creator_id = context.character_creator_id
             
-            # Check user credits
-            user = service.user_repository.get_by_id(user_id)
-            if user.credits < 1:
-                raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
+                # Check and charge the credit in one atomic UPDATE ... RETURNING
+                # (refunded if no reply gets saved)
+                if service.user_repository.try_consume_credit(user_id) is None:
+                    raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
             
-            # Get conversation history and system message
-            system_message = conversation.system_message
-            history = service.get_conversation_messages(conversation_id)
-            
-            # Create detached copies to avoid database session issues
-            for msg in history:
-                detached_history.append(DetachedMessage(
-                    role=msg.role,
-                    content=msg.content
-                ))
-            
-            # Add user message
-            user_message = service.repository.add_message(
-                conversation_id=conversation_id,
-                role="user",
-                content=message_content
-            )
-            user_message_id = user_message.id
+                # Get conversation history (already detached from the session) and system message
+                system_message = context.system_message
+                detached_history = service.get_history_window_at(conversation_id, context.latest_message_id)
             
-            # Commit the user message
-            db_read.commit()
-        except Exception as setup_error:
-            db_read.rollback()
-            logger.error(f"Error in send message setup: {str(setup_error)}")
-            raise setup_error
-        finally:
-            # Close the DB connection before API call
-            db_read.close()
+                # Commit the credit charge; both messages are written together
+                # once the reply is back
+                db_read.commit()
+            except Exception as setup_error:
+                db_read.rollback()
+                logger.error(f"Error in send message setup: {str(setup_error)}")
+                raise setup_error
         
         # STEP 2: Call LLM API without holding any DB connection
-        llm_service = LLMService()
-        ai_response = await llm_service.process_message(system_message, detached_history, message_content)
-        
-        # STEP 3: Single database session for all updates
-        db_write = next(get_db())
+        llm_service = get_llm_service()
         try:
-            # Use a single transaction for all updates to minimize roundtrips
-            service = ConversationService(db_write)
-            
-            # Add AI response message
-            ai_message = service.repository.add_message(
-                conversation_id=conversation_id,
-                role="assistant",
-                content=ai_response
+            ai_response = await llm_service.process_message(
+                system_message, detached_history, message_content, cache_key=str(conversation_id)
             )
+        except Exception:
+            # No reply was produced, so give the credit back
+            with SessionScope() as db_refund:
+                ConversationService(db_refund).refund_credit(user_id)
+            raise
+        
+        # STEP 3: Single database session for all updates
+        with SessionScope() as db_write:
+            try:
+                # Use a single transaction for all updates to minimize roundtrips
+                service = ConversationService(db_write)
             
-            # Use batch updates for the rest of the changes
-            updates = [
-                # Update conversation timestamp
-                (
-                    "UPDATE conversations SET last_chatted_with = NOW() WHERE id = :id",
-                    {"id": conversation_id}
-                ),
-                # Deduct user credit (atomic operation)
-                (
-                    "UPDATE users SET credits = credits - 1 WHERE id = :id AND credits >= 1",
-                    {"id": user_id}
-                ),
-                # Increment character creator's message counter (atomic operation)
-                (
-                    "UPDATE users SET character_messages_received = character_messages_received + 1 WHERE id = :id",
-                    {"id": character_creator_id}
+                # Add the user message and the AI response in one INSERT
+                user_message, ai_message = service.repository.add_messages(
+                    conversation_id,
+                    [("user", message_content), ("assistant", ai_response)]
                 )
-            ]
             
-            # Execute the batch updates
-            batch_update(db_write, updates)
+                # Use batch updates for the rest of the changes
+                updates = [
+                    # Update conversation timestamp
+                    (
+                        "UPDATE conversations SET last_chatted_with = NOW() WHERE id = :id",
+                        {"id": conversation_id}
+                    ),
+                    # Increment character creator's message counter (atomic operation)
+                    (
+                        "UPDATE users SET character_messages_received = character_messages_received + 1 WHERE id = :id",
+                        {"id": character_creator_id}
+                    )
+                ]
             
-            # Get the messages to return
-            user_message_obj = service.repository.get_message_by_id(user_message_id)
-            ai_message_obj = ai_message
+                # Execute the batch updates
+                batch_update(db_write, updates)
             
-            db_write.commit()
+                db_write.commit()
+                
+                remember_message(conversation_id, user_message.id, "user", user_message.content)
+                remember_message(conversation_id, ai_message.id, "assistant", ai_message.content)
             
-            # Return both messages
-            return [
-                MessageResponse(
-                    id=user_message_obj.id,
-                    role=user_message_obj.role,
-                    content=user_message_obj.content
-                ),
-                MessageResponse(
-                    id=ai_message_obj.id,
-                    role=ai_message_obj.role,
-                    content=ai_message_obj.content
-                )
-            ]
-        except Exception as db_error:
-            db_write.rollback()
-            logger.error(f"Error in message response handling: {str(db_error)}")
-            raise HTTPException(status_code=500, detail=str(db_error))
-        finally:
-            db_write.close()
+                # Return both messages (plain records, still readable after commit)
+                return [
+                    MessageResponse(
+                        id=user_message.id,
+                        role=user_message.role,
+                        content=user_message.content
+                    ),
+                    MessageResponse(
+                        id=ai_message.id,
+                        role=ai_message.role,
+                        content=ai_message.content
+                    )
+                ]
+            except Exception as db_error:
+                db_write.rollback()
+                logger.error(f"Error in message response handling: {str(db_error)}")
+                # The reply wasn't saved, so don't charge for it
+                service.refund_credit(user_id)
+                raise HTTPException(status_code=500, detail=str(db_error))
             
     except ValueError as e:
         logger.error(f"Error sending message: {str(e)}")
@@ -219,12 +194,14 @@ async def send_message(
 @router.get("/{conversation_id}/messages", response_model=List[MessageResponse])
 async def get_conversation_messages(
     conversation_id: int,
+    limit: Optional[int] = Query(None, ge=1),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
+    """Get a conversation's messages; pass limit to fetch only the most recent ones"""
     try:
         service = ConversationService(db)
-        messages = service.get_conversation_messages(conversation_id)
+        messages = service.get_conversation_messages(conversation_id, limit=limit)
         if not messages:
             raise HTTPException(status_code=404, detail="Conversation not found")
         return messages
@@ -244,8 +221,7 @@ async def get_conversations(
         conversations = service.get_conversations_with_characters(current_user.id)
         return conversations
     except Exception as e:
-        logger.error(f"Error getting conversations: {str(e)}")
-        logger.exception("Full traceback:")
+        logger.error("Error getting conversations: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/", response_model=int)
@@ -288,121 +264,115 @@ async def stream_message(
         
         # STEP 1: Single comprehensive database session for preparation
         # This consolidates multiple database operations into one session
-        db_read = next(get_db())
-        
-        conversation = None
-        character_creator_id = None
-        system_message = None
-        detached_history = []
-        user_message_id = None
-        ai_message_id = None
+        with SessionScope() as db_read:
+            character_creator_id = None
+            system_message = None
+            detached_history = []
+            user_message_id = None
+            ai_message_id = None
         
-        try:
-            # Get conversation with all needed data in a single query
-            service = ConversationService(db_read)
-            conversation = service.repository.get_by_id(conversation_id)
+            try:
+                # Get conversation, access and character creator in a single query
+                service = ConversationService(db_read)
+                context = service.repository.get_turn_context(conversation_id, user_id)
             
-            if not conversation:
-                raise ValueError("Conversation not found")
+                if not context:
+                    raise ValueError("Conversation not found")
                 
-            # Check if user has access to this conversation
-            if conversation.creator_id != user_id and user_id not in [p.id for p in conversation.participants]:
-                raise ValueError("User does not have access to this conversation")
-            
-            # Get user for credit check (access pattern optimized)
-            user = service.user_repository.get_by_id(user_id)
-            if user.credits < 1:
-                raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
+                # Check if user has access to this conversation
+                if not context.has_access:
+                    raise ValueError("User does not have access to this conversation")
             
-            # Store essential data needed during streaming
-            character_creator_id = conversation.character.creator_id
-            system_message = conversation.system_message
+                # Check and charge the credit in one atomic UPDATE ... RETURNING
+                # (committed with the messages; refunded if the stream fails)
+                if service.user_repository.try_consume_credit(user_id) is None:
+                    raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
             
-            # Get conversation history and create detached copies to avoid DB dependency
-            history = service.get_conversation_messages(conversation_id)
-            for msg in history:
-                # Create DetachedMessage objects instead of dictionaries
-                detached_history.append(DetachedMessage(
-                    role=msg.role,
-                    content=msg.content
-                ))
+                # Store essential data needed during streaming
+                character_creator_id = context.character_creator_id
+                system_message = context.system_message
             
-            # Add user message - this now uses a direct repository call
-            user_message = service.repository.add_message(
-                conversation_id=conversation_id,
-                role="user",
-                content=message_content
-            )
-            user_message_id = user_message.id
+                # Get conversation history as detached copies to avoid DB dependency
+                detached_history = service.get_history_window_at(conversation_id, context.latest_message_id)
             
-            # Initialize empty AI message
-            ai_message = service.repository.add_message(
-                conversation_id=conversation_id,
-                role="assistant",
-                content=""
-            )
-            ai_message_id = ai_message.id
+                # Add user message and an empty AI message in one INSERT
+                user_message, ai_message = service.repository.add_messages(
+                    conversation_id,
+                    [("user", message_content), ("assistant", "")]
+                )
+                user_message_id = user_message.id
+                ai_message_id = ai_message.id
             
-            # Perform all database writes in a single commit
-            db_read.commit()
-        except Exception as setup_error:
-            db_read.rollback()
-            logger.error(f"Error in stream message setup: {str(setup_error)}")
-            raise setup_error
-        finally:
-            # Close the DB connection before starting streaming
-            db_read.close()
+                # Perform all database writes in a single commit
+                db_read.commit()
+            except Exception as setup_error:
+                db_read.rollback()
+                logger.error(f"Error in stream message setup: {str(setup_error)}")
+                raise setup_error
         
         # STEP 2: Set up LLM service for streaming (no DB connection held)
-        llm_service = LLMService()
+        llm_service = get_llm_service()
         
         async def event_generator():
-            # Stream AI response without holding a DB connection
-            accumulated_content = ""
+            # Stream AI response without holding a DB connection, buffering
+            # tokens in a list that is joined once at the end
+            chunks = []
+            # Set once the reply is saved; anything else (an error, or the
+            # client disconnecting and the generator being cancelled or
+            # closed) is cleaned up in the finally block
+            settled = False
             try:
-                async for token in llm_service.stream_message(system_message, detached_history, message_content):
-                    accumulated_content += token
+                async for token in llm_service.stream_message(
+                    system_message, detached_history, message_content, cache_key=str(conversation_id)
+                ):
+                    chunks.append(token)
                     yield {
                         "event": "token",
                         "data": token
                     }
+                accumulated_content = "".join(chunks)
                 
                 # STEP 3: Final database updates in a SINGLE transaction
                 # This consolidates multiple updates into one database session with minimal operations
-                db_update = next(get_db())
-                try:
-                    # Use batch update to perform all database changes in one transaction
-                    # This significantly reduces roundtrips for global deployments
-                    updates = [
-                        # Update message content
-                        (
-                            "UPDATE messages SET content = :content WHERE id = :id",
-                            {"content": accumulated_content, "id": ai_message_id}
-                        ),
-                        # Update conversation timestamp
-                        (
-                            "UPDATE conversations SET last_chatted_with = NOW() WHERE id = :id",
-                            {"id": conversation_id}
-                        ),
-                        # Deduct user credit (atomic operation)
-                        (
-                            "UPDATE users SET credits = credits - 1 WHERE id = :id AND credits >= 1",
-                            {"id": user_id}
-                        ),
-                        # Increment character creator's message counter (atomic operation)
-                        (
-                            "UPDATE users SET character_messages_received = character_messages_received + 1 WHERE id = :id",
-                            {"id": character_creator_id}
-                        )
-                    ]
+                with SessionScope() as db_update:
+                    try:
+                        # Use batch update to perform all database changes in one transaction
+                        # This significantly reduces roundtrips for global deployments
+                        updates = [
+                            # Update message content
+                            (
+                                "UPDATE messages SET content = :content WHERE id = :id",
+                                {"content": accumulated_content, "id": ai_message_id}
+                            ),
+                            # Update conversation timestamp
+                            (
+                                "UPDATE conversations SET last_chatted_with = NOW() WHERE id = :id",
+                                {"id": conversation_id}
+                            ),
+                            # Increment character creator's message counter (atomic operation)
+                            (
+                                "UPDATE users SET character_messages_received = character_messages_received + 1 WHERE id = :id",
+                                {"id": character_creator_id}
+                            )
+                        ]
                     
-                    # Execute all updates in one transaction
-                    batch_update(db_update, updates)
-                except Exception as db_error:
-                    db_update.rollback()
-                    logger.error(f"Error updating message after streaming: {str(db_error)}")
-                finally:
-                    db_update.close()
+                        # Execute all updates in one transaction
+                        if batch_update(db_update, updates):
+                            settled = True
+                            remember_message(conversation_id, user_message_id, "user", message_content)
+                            remember_message(conversation_id, ai_message_id, "assistant", accumulated_content)
+                    except Exception as db_error:
+                        db_update.rollback()
+                        logger.error(f"Error updating message after streaming: {str(db_error)}")
+                
+                if not settled:
+                    # The reply was streamed but not saved (it is discarded
+                    # and refunded below), so don't report it as done
+                    yield {
+                        "event": "error",
+                        "data": "Failed to save the response"
+                    }
+                    return
                 
                 # Send done event when streaming completes successfully
                 yield {
@@ -415,6 +385,12 @@ async def stream_message(
                     "event": "error",
                     "data": str(stream_error)
                 }
+            finally:
+                if not settled:
+                    # The reply wasn't saved, so drop its empty placeholder
+                    # and don't charge for it
+                    with SessionScope() as db_refund:
+                        ConversationService(db_refund).discard_reply(user_id, conversation_id, ai_message_id)
         
         return EventSourceResponse(event_generator())
         
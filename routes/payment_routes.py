@@ -97,7 +97,7 @@ async def initiate_payment(
         
     try:
         # Initialize payment
-        payment_details = PaymentService.initiate_payment(
+        payment_details = await PaymentService.initiate_payment(
             user_id=current_user.id,
             credits=credits,
             token_type=token_type
@@ -184,7 +184,7 @@ async def get_payment_history(
 ):
     """Get payment history for the current user"""
     try:
-        payments = PaymentService.get_user_payments(
+        payments = await PaymentService.get_user_payments(
             user_id=current_user.id,
             status=status
         )
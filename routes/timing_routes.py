@@ -4,6 +4,7 @@ from sqlalchemy.orm import Session
 from database.database import get_db
 from database.models import User, RequestLog
 from services.timing import TimingService
+from services.llm_service import get_usage_stats
 from dependencies.auth import get_current_user
 import logging
 
@@ -50,6 +51,16 @@ async def get_timing_stats(
     service = TimingService(db)
     return service.get_endpoint_stats(endpoint)
 
+@router.get("/llm-usage")
+async def get_llm_usage_stats(
+    current_user: User = Depends(get_current_user)
+):
+    """Get LLM token usage and prompt cache hit ratio for this process (requires authentication)"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    return get_usage_stats()
+
 @router.get("/message-operations")
 async def get_message_operation_stats(
     limit: int = Query(100, ge=1, le=500),
@@ -1,19 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import select, func, update, exists, and_
 from typing import Optional
-from pydantic import BaseModel, Field
-from datetime import datetime
+from pydantic import BaseModel, Field, validator
 import json
+import orjson
 import logging
 import re
-from database.database import get_db, SessionLocal
-from database.models import User, WorldIDVerification
-from repositories.user_repository import UserRepository
+from database.database import get_db, SessionScope
+from database.models import User, WorldIDVerification, Character
+from database.db_utils import record_last_active
 from services.user_service import UserService
-from services.world_id_service import WorldIDService
-from services.siwe_service import SIWEService
-from dependencies.auth import get_current_user, create_session
-from web3 import Web3
+from dependencies.auth import get_current_user, checksum_address
 
 logger = logging.getLogger(__name__)
 router = APIRouter(tags=["users"])
@@ -37,6 +35,26 @@ class UserResponse(BaseModel):
     language: str
     credits: int
 
+    class Config:
+        orm_mode = True
+
+    # Provide defaults for columns that may be null in older rows. language
+    # and credits stop being NULL once migrations/user_profile_defaults.py
+    # has run, but until then legacy rows would fail validation with a 500.
+    # username keeps its fallback regardless: it is unique, so it can't
+    # share a column default
+    @validator("username", pre=True, always=True)
+    def default_username(cls, v):
+        return v or "User"
+
+    @validator("language", pre=True, always=True)
+    def default_language(cls, v):
+        return v or "en"
+
+    @validator("credits", pre=True, always=True)
+    def default_credits(cls, v):
+        return v if v is not None else 0
+
 class WorldIDCredentials(BaseModel):
     nullifier_hash: str
     merkle_root: str
@@ -49,6 +67,8 @@ class UserUpdate(BaseModel):
     language: Optional[str] = None
     wallet_address: Optional[str] = None
 
+ACCEPT_LANGUAGE_PATTERN = re.compile(r'([a-zA-Z]{1,8}(-[a-zA-Z0-9]{1,8})?)\s*(;\s*q\s*=\s*((1(\.0)?)|0\.\d+))?')
+
 def parse_accept_language(accept_language: str) -> str:
     """
     Parse the Accept-Language header and return the best language code.
@@ -58,13 +78,19 @@ def parse_accept_language(accept_language: str) -> str:
     if not accept_language:
         return "en"  # Default to English
     
+    # Fast path for the common single-token headers like 'en' or 'en-US'
+    if len(accept_language) <= 5 and accept_language.isascii():
+        if len(accept_language) == 2 and accept_language.isalpha():
+            return accept_language.lower()
+        if (len(accept_language) == 5 and accept_language[2] == '-'
+                and accept_language[:2].isalpha() and accept_language[3:].isalpha()):
+            return accept_language[:2].lower()
+    
     # Parse the header to extract languages and their quality values
     languages = []
     
     # Using regex to handle various formats of Accept-Language
-    pattern = re.compile(r'([a-zA-Z]{1,8}(-[a-zA-Z0-9]{1,8})?)\s*(;\s*q\s*=\s*((1(\.0)?)|0\.\d+))?')
-    
-    for match in pattern.finditer(accept_language):
+    for match in ACCEPT_LANGUAGE_PATTERN.finditer(accept_language):
         lang = match.group(1)
         # If quality factor is present, use it; otherwise, assume 1.0
         q = match.group(4) or "1.0"
@@ -79,7 +105,7 @@ def parse_accept_language(accept_language: str) -> str:
     # Get the primary language code (first two letters) from the best match
     best_lang = languages[0][0].split('-')[0].lower()
     
-    logger.info(f"Parsed Accept-Language header: {accept_language} -> {best_lang}")
+    logger.debug("Parsed Accept-Language header: %s -> %s", accept_language, best_lang)
     return best_lang
 
 async def verify_world_id_credentials(
@@ -87,16 +113,13 @@ async def verify_world_id_credentials(
     db: Session = Depends(get_db)
 ) -> Optional[WorldIDCredentials]:
     """Verify World ID credentials from header and check stored verifications"""    
-    logger.info("Verifying World ID credentials from header")
-    
     credentials = request.headers.get('X-WorldID-Credentials')
     if not credentials:
-        logger.info("No credentials found in header")
         return None
         
     try:
-        creds = json.loads(credentials)
-        logger.info(f"Received credentials for nullifier_hash: {creds['nullifier_hash']}")
+        creds = orjson.loads(credentials)
+        logger.debug("Received credentials for nullifier_hash: %s", creds['nullifier_hash'])
         
         parsed_creds = WorldIDCredentials(
             nullifier_hash=creds["nullifier_hash"],
@@ -105,30 +128,34 @@ async def verify_world_id_credentials(
             verification_level=creds["verification_level"]
         )
         
-        # Check for existing verification
-        verification = db.query(WorldIDVerification).filter(
-            WorldIDVerification.nullifier_hash == parsed_creds.nullifier_hash
+        # Check for existing verification (plain rows, no ORM identity map)
+        verification = db.execute(
+            select(WorldIDVerification.id)
+            .where(WorldIDVerification.nullifier_hash == parsed_creds.nullifier_hash)
+            .limit(1)
         ).first()
         
         if not verification:
-            logger.error(f"No verification found for nullifier_hash: {parsed_creds.nullifier_hash}")
+            logger.error("No verification found for nullifier_hash: %s", parsed_creds.nullifier_hash)
             return None
         
-        # Update user's last_active timestamp
-        user = db.query(User).filter(
-            User.world_id == parsed_creds.nullifier_hash
+        user = db.execute(
+            select(User.id).where(User.world_id == parsed_creds.nullifier_hash)
         ).first()
         
-        if user:
-            user.last_active = datetime.utcnow()
-            db.commit()
-        else:
-            logger.error(f"No user found with world_id: {parsed_creds.nullifier_hash}")
+        if not user:
+            logger.error("No user found with world_id: %s", parsed_creds.nullifier_hash)
+            return parsed_creds
+        
+        (user_id,) = user
+        
+        # Queue user's last_active timestamp for the batched flush
+        record_last_active(user_id)
             
         return parsed_creds
         
-    except (json.JSONDecodeError, KeyError) as e:
-        logger.error(f"Error parsing credentials: {str(e)}")
+    except (orjson.JSONDecodeError, json.JSONDecodeError, KeyError) as e:
+        logger.error("Error parsing credentials: %s", e)
         return None
 
 async def verify_wallet_address(
@@ -136,37 +163,33 @@ async def verify_wallet_address(
     db: Session = Depends(get_db)
 ) -> Optional[str]:
     """Verify wallet address from header and check if it's linked to a user"""
-    logger.info("Verifying wallet address from header")
-    
     wallet_address = request.headers.get('X-Wallet-Address')
     if not wallet_address:
-        logger.info("No wallet address found in header")
         return None
     
     try:
-        # Validate wallet address format
-        if not Web3.is_address(wallet_address):
-            logger.error(f"Invalid wallet address format: {wallet_address}")
+        # Validate wallet address format and convert to checksum address
+        checksum = checksum_address(wallet_address)
+        if checksum is None:
+            logger.error("Invalid wallet address format: %s", wallet_address)
             return None
-            
-        # Convert to checksum address
-        wallet_address = Web3.to_checksum_address(wallet_address)
+        wallet_address = checksum
         
         # Check if wallet address is linked to a user
-        user = db.query(User).filter(
-            User.wallet_address == wallet_address
+        user = db.execute(
+            select(User.id).where(User.wallet_address == wallet_address)
         ).first()
         
-        if user:
-            user.last_active = datetime.utcnow()
-            db.commit()
-            return wallet_address
-        else:
-            logger.error(f"No user found with wallet address: {wallet_address}")
+        if not user:
+            logger.error("No user found with wallet address: %s", wallet_address)
             return None
+        
+        (user_id,) = user
+        record_last_active(user_id)
+        return wallet_address
             
     except Exception as e:
-        logger.error(f"Error verifying wallet address: {str(e)}")
+        logger.error("Error verifying wallet address: %s", e)
         return None
 
 @router.get("/{user_id}/stats")
@@ -206,116 +229,144 @@ async def verify_world_id(
     Note: This route is being maintained for backward compatibility
     but will be deprecated in favor of the wallet-based auth
     """
+    # Legacy endpoint: import its dependencies on first use instead of at startup
+    from repositories.user_repository import UserRepository
+    from services.world_id_service import WorldIDService
+    from dependencies.auth import create_session
+
     # Following optimized DB connection pattern
-    db = SessionLocal()
-    try:
-        # Get language from Accept-Language header
-        accept_language = req.headers.get("accept-language", "en")
-        language = parse_accept_language(accept_language)
-        logger.info(f"Using language from header: {language}")
+    with SessionScope() as db:
+        try:
+            # Get language from Accept-Language header
+            accept_language = req.headers.get("accept-language", "en")
+            language = parse_accept_language(accept_language)
+            logger.info("Using language from header: %s", language)
         
-        user_repo = UserRepository(db)
-        world_id_service = WorldIDService(user_repo)
+            user_repo = UserRepository(db)
+            world_id_service = WorldIDService(user_repo)
         
-        result = await world_id_service.verify_proof(
-            nullifier_hash=request.nullifier_hash,
-            merkle_root=request.merkle_root,
-            proof=request.proof,
-            verification_level=request.verification_level,
-            action=request.action,
-            language=language
-        )
+            result = await world_id_service.verify_proof(
+                nullifier_hash=request.nullifier_hash,
+                merkle_root=request.merkle_root,
+                proof=request.proof,
+                verification_level=request.verification_level,
+                action=request.action,
+                language=language
+            )
         
-        # Create session token after successful verification
-        session_token = create_session(result["user"]["id"], db)
+            # Create session token after successful verification
+            session_token = create_session(result["user"]["id"], db)
         
-        # Return both the verification result and session token
-        return {
-            **result,
-            "session_token": session_token
-        }
+            # Return both the verification result and session token
+            return {
+                **result,
+                "session_token": session_token
+            }
         
-    except ValueError as e:
-        logger.error(f"Verification error: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
+        except ValueError as e:
+            logger.error(f"Verification error: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/me", response_model=UserResponse)
 async def get_current_user_info(
     current_user: User = Depends(get_current_user)
 ):
     """Get the current user's information"""
-    # Convert the SQLAlchemy model to a dict for the Pydantic model
-    return {
-        "id": current_user.id,
-        "wallet_address": current_user.wallet_address,
-        "world_id": current_user.world_id,
-        "username": current_user.username or "User",  # Provide default if null
-        "language": current_user.language or "en",    # Provide default if null
-        "credits": current_user.credits or 0          # Provide default if null
-    }
+    # response_model validates the ORM object once via orm_mode
+    return current_user
 
 @router.get("/stats", response_model=dict)
-async def get_user_stats(
+async def get_current_user_stats(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get user stats"""
     try:
+        # Counters and character count in one round-trip, no row lock needed for a read.
+        # The count runs directly on characters.creator_id (no join through users)
+        character_count = select(func.count())\
+            .select_from(Character)\
+            .where(Character.creator_id == current_user.id)\
+            .scalar_subquery()
+        stats = db.execute(
+            select(
+                User.credits_spent,
+                User.character_messages_received,
+                User.tokens_redeemed,
+                User.username,
+                character_count.label("characters")
+            ).where(User.id == current_user.id)
+        ).first()
+        if not stats:
+            raise HTTPException(status_code=404, detail="User not found")
+        
         return {
-            "credits_used": current_user.credits_spent,
-            "messages_sent": current_user.character_messages_received,
-            "characters": len(current_user.created_characters),
-            "username": current_user.username,
-            "character_messages_received": current_user.character_messages_received,
-            "tokens_redeemed": current_user.tokens_redeemed
+            "credits_used": stats.credits_spent,
+            "messages_sent": stats.character_messages_received,
+            "characters": stats.characters,
+            "username": stats.username,
+            "character_messages_received": stats.character_messages_received,
+            "tokens_redeemed": stats.tokens_redeemed
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting user stats: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/update", response_model=UserResponse)
 async def update_user(
-    user_update: UserUpdate
+    user_update: UserUpdate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
 ):
     """Update user profile"""
-    # Following optimized DB connection pattern
-    db = SessionLocal()
     try:
-        # Get current user - need to replicate dependency logic
-        current_user = get_current_user(db=db)
+        update_values = user_update.dict(exclude_unset=True, exclude_none=True)
+        if not update_values:
+            return current_user
+        
+        stmt = update(User).where(User.id == current_user.id)
         
         # Validate wallet address if provided
-        if user_update.wallet_address:
-            if not Web3.is_address(user_update.wallet_address):
+        new_wallet = None
+        if "wallet_address" in update_values:
+            new_wallet = checksum_address(update_values["wallet_address"])
+            if new_wallet is None:
                 raise HTTPException(status_code=400, detail="Invalid Ethereum address")
             # Convert to checksum address
-            user_update.wallet_address = Web3.to_checksum_address(user_update.wallet_address)
-            
-            # Check if wallet is already linked to another account
-            existing_user = db.query(User).filter(
-                User.wallet_address == user_update.wallet_address,
-                User.id != current_user.id
-            ).first()
+            update_values["wallet_address"] = new_wallet
             
-            if existing_user:
+            # Only apply the update if the wallet is not linked to another account,
+            # checked in the same statement so there is no race between check and write
+            other_user = aliased(User)
+            stmt = stmt.where(~exists().where(and_(
+                other_user.wallet_address == new_wallet,
+                other_user.id != current_user.id
+            )))
+        
+        updated_user = db.execute(
+            stmt.values(**update_values).returning(User)
+        ).scalars().first()
+        
+        if not updated_user:
+            db.rollback()
+            if new_wallet and db.query(User.id).filter(User.wallet_address == new_wallet).first():
                 raise HTTPException(
                     status_code=409, 
                     detail="This wallet is already linked to another account"
                 )
-            
-        service = UserService(db)
-        updated_user = service.update_user(
-            current_user.id,
-            user_update.dict(exclude_unset=True)
-        )
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        db.commit()
+        
         return updated_user
+    except HTTPException:
+        raise
     except Exception as e:
+        db.rollback()
         logger.error(f"Error updating user: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
@@ -1,13 +1,8 @@
-import os
-import sys
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from database.models import Base, User, WorldIDVerification
-from database.database import DATABASE_URL
-from datetime import datetime
+from database.database import engine, SessionLocal
+from sqlalchemy import insert
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TEST_WORLD_ID = "test_nullifier_123"
 
 def create_test_user():
     # Create all tables
@@ -16,33 +11,27 @@ def create_test_user():
     db = SessionLocal()
     try:
         # Check if test user already exists
-        existing_user = db.query(User).filter(User.world_id == "test_nullifier_123").first()
+        existing_user = db.query(User).filter(User.world_id == TEST_WORLD_ID).first()
         if existing_user:
             print(f"Test user already exists with world_id: {existing_user.world_id}")
             return
             
-        # Create a test user with a fake nullifier hash
-        test_user = User(
-            world_id="test_nullifier_123",
-            language="en",
-            credits=100,
-            created_at=datetime.utcnow(),
-            last_active=datetime.utcnow()
-        )
-        db.add(test_user)
-        db.flush()  # Get the user ID
+        # Create a test user with a fake nullifier hash; created_at/last_active
+        # come from the column defaults and RETURNING hands back the ID (no flush)
+        user_id = db.execute(
+            insert(User)
+            .values(world_id=TEST_WORLD_ID, language="en", credits=100)
+            .returning(User.id)
+        ).scalar_one()
         
         # Create a verification record
-        verification = WorldIDVerification(
-            user_id=test_user.id,
-            nullifier_hash=test_user.world_id,
-            merkle_root="test_merkle_root",
-            created_at=datetime.utcnow()
+        db.execute(
+            insert(WorldIDVerification)
+            .values(user_id=user_id, nullifier_hash=TEST_WORLD_ID, merkle_root="test_merkle_root")
         )
-        db.add(verification)
         
         db.commit()
-        print(f"Created test user with world_id: {test_user.world_id}")
+        print(f"Created test user with world_id: {TEST_WORLD_ID}")
         
     except Exception as e:
         print(f"Error creating test user: {e}")
@@ -16,18 +16,23 @@ def get_language_stats():
     """Get user statistics by language"""
     db = SessionLocal()
     try:
-        # Count users by language
+        # Count users by language; the total and each share come from a
+        # window over the grouped counts, all in the same scan
+        user_count = func.count(User.id)
+        total = func.sum(user_count).over()
         result = db.query(
             User.language,
-            func.count(User.id).label('user_count')
+            user_count.label('user_count'),
+            total.label('total_users'),
+            (100.0 * user_count / total).label('percentage')
         ).group_by(
             User.language
         ).order_by(
-            func.count(User.id).desc()
+            user_count.desc()
         ).all()
         
         # Print formatted results
-        total_users = sum(count for _, count in result)
+        total_users = result[0].total_users if result else 0
         
         print(f"\n{'=' * 50}")
         print(f"USER LANGUAGE STATISTICS - TOTAL USERS: {total_users}")
@@ -35,9 +40,8 @@ def get_language_stats():
         print(f"{'LANGUAGE':<10} | {'COUNT':<8} | {'PERCENTAGE':<10}")
         print(f"{'-' * 10} | {'-' * 8} | {'-' * 10}")
         
-        for language, count in result:
-            percentage = (count / total_users) * 100 if total_users > 0 else 0
-            print(f"{language:<10} | {count:<8} | {percentage:.2f}%")
+        for row in result:
+            print(f"{row.language:<10} | {row.user_count:<8} | {row.percentage:.2f}%")
             
         print(f"{'=' * 50}\n")
         
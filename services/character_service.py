@@ -1,11 +1,42 @@
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Any
 from sqlalchemy.orm import Session
 from repositories.character_repository import CharacterRepository
 from database.models import Character
+from database.db_utils import is_popular_view_ready
+import base64
+import json
+from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
+def encode_cursor(*values) -> str:
+    """Encode the sort key of a page's last row as an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode()
+
+def decode_cursor(cursor: str, *converters) -> tuple:
+    """
+    Decode a cursor produced by encode_cursor, passing each value through the
+    matching converter. Raises ValueError if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(converters):
+            raise ValueError("Invalid cursor")
+        return tuple(convert(value) for convert, value in zip(converters, values))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+def text_value(value) -> str:
+    """Cursor converter for a text sort key; rejects anything but a string"""
+    if not isinstance(value, str):
+        raise TypeError("Expected a string")
+    return value
+
+def nullable(convert):
+    """Cursor converter for a sort key that may be NULL in the database"""
+    return lambda value: None if value is None else convert(value)
+
 class CharacterService:
     def __init__(self, db: Session):
         self.repository = CharacterRepository(db)
@@ -23,7 +54,7 @@ class CharacterService:
         character_types: List[str] = []
     ) -> Character:
         """Create a new character"""
-        logger.info(f"Creating character '{name}' with language: {language}")
+        logger.info("Creating character '%s' with language: %s", name, language)
         character_data = {
             "name": name,
             "character_description": character_description,
@@ -41,28 +72,83 @@ class CharacterService:
         
         return self.repository.create(character_data)
     
-    def get_popular_characters(self, page: int = 1, per_page: int = 10, language: str = "en") -> List[Character]:
-        """Get popular characters ordered by number of messages"""
-        # logger.info(f"Getting popular characters for language: {language}")
-        skip = (page - 1) * per_page
-        characters = self.repository.get_by_popularity(skip=skip, limit=per_page, language=language)
-        # logger.info(f"Found {len(characters)} popular characters for language {language}")
-        return characters
+    def get_popular_characters(
+        self,
+        cursor: Optional[str] = None,
+        per_page: int = 10,
+        language: str = "en",
+        page: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Get popular characters ordered by number of messages.
+        
+        Pages are keyed on (num_messages, id) of the previous page's last row,
+        passed back as the opaque next_cursor. The page argument is the
+        deprecated page-number fallback and is only used when no cursor is given;
+        every page of it, the first included, reads ranks from
+        popular_characters_mv when available (OFFSET otherwise), and no
+        next_cursor is returned, so a traversal never mixes the periodically
+        refreshed ranking with the live keyset query.
+        
+        Returns:
+            {"data": [Character, ...], "next_cursor": str or None}
+        """
+        if cursor is None and page is not None:
+            skip = (max(page, 1) - 1) * per_page
+            if is_popular_view_ready():
+                characters = self.repository.get_by_popularity_rank(skip=skip, limit=per_page, language=language)
+            else:
+                characters = self.repository.get_by_popularity(skip=skip, limit=per_page, language=language)
+            return {"data": characters, "next_cursor": None}
+        else:
+            key = decode_cursor(cursor, nullable(int), int) if cursor else None
+            characters = self.repository.get_by_popularity_keyset(cursor=key, limit=per_page, language=language)
+        
+        next_cursor = None
+        if characters and len(characters) == per_page:
+            last = characters[-1]
+            next_cursor = encode_cursor(last.num_messages, last.id)
+        return {"data": characters, "next_cursor": next_cursor}
     
-    def get_character(self, character_id: int, language: str = "en") -> Optional[Character]:
-        """Get character details by ID"""
-        # logger.info(f"Getting character with ID {character_id} for language: {language}")
-        character = self.repository.get_by_id(character_id)
-        # if character and character.language == language:
-            # logger.info(f"Found character with ID {character_id} for language {language}")
-        return character
+    def get_character(self, character_id: int, language: Optional[str] = None) -> Optional[Character]:
+        """
+        Get character details by ID.
+        
+        With a language, characters in other languages are treated as missing
+        and filtered in SQL rather than loaded and discarded.
+        """
+        if language is None:
+            return self.repository.get_by_id(character_id)
+        return self.repository.get_by_id_and_language(character_id, language)
     
-    def get_creator_characters(self, creator_id: int, language: str = "en") -> List[Character]:
-        """Get all characters created by a user"""
-        # logger.info(f"Getting characters created by user {creator_id} for language: {language}")
-        characters = self.repository.get_by_creator(creator_id, language=language)
-        # logger.info(f"Found {len(characters)} characters created by user {creator_id} for language {language}")
-        return characters
+    def get_creator_characters(
+        self,
+        creator_id: int,
+        language: str = "en",
+        cursor: Optional[str] = None,
+        per_page: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Get characters created by a user, newest first.
+        
+        Pages are keyed on (created_at, id) of the previous page's last row.
+        Without per_page all of the user's characters are returned.
+        
+        Returns:
+            {"data": [Character, ...], "next_cursor": str or None}
+        """
+        key = None
+        if cursor:
+            key = decode_cursor(cursor, nullable(datetime.fromisoformat), int)
+        characters = self.repository.get_by_creator_keyset(
+            creator_id, cursor=key, limit=per_page, language=language
+        )
+        
+        next_cursor = None
+        if per_page is not None and characters and len(characters) == per_page:
+            last = characters[-1]
+            next_cursor = encode_cursor(last.created_at.isoformat() if last.created_at else None, last.id)
+        return {"data": characters, "next_cursor": next_cursor}
     
     def get_stats(self, character_id: int, language: str = "en") -> Optional[dict]:
         """Get character statistics"""
@@ -73,23 +159,42 @@ class CharacterService:
         return stats
     
     def update_character_image(self, character_id: int, photo_url: str, language: str = "en") -> Optional[Character]:
-        """Update a character's photo URL"""
-        # logger.info(f"Updating character with ID {character_id} for language: {language}")
-        character = self.repository.get_by_id(character_id)
-        if not character:
-            return None
-            
-        return self.repository.update(character_id, {"photo_url": photo_url})
+        """Update a character's photo URL, returning None if the character doesn't exist"""
+        return self.repository.update_returning(character_id, {"photo_url": photo_url})
 
-    def search_characters(self, query: str, page: int = 1, per_page: int = 10, language: str = "en") -> List[Character]:
-        """Search characters by name, tagline, or description"""
-        # logger.info(f"Searching characters for query '{query}' and language: {language}")
-        skip = (page - 1) * per_page
-        characters = self.repository.search(query, skip=skip, limit=per_page, language=language)
-        # logger.info(f"Found {len(characters)} characters for query '{query}' and language {language}")
-        return characters
+    def search_characters(
+        self,
+        query: str,
+        cursor: Optional[str] = None,
+        per_page: int = 10,
+        language: str = "en",
+        page: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Search characters by name, tagline, or description.
+        
+        Results are ordered by (name, id) and paged with the opaque cursor;
+        page is the deprecated OFFSET fallback used only without a cursor.
+        
+        Returns:
+            {"data": [Character, ...], "next_cursor": str or None}
+        """
+        if cursor is None and page is not None and page > 1:
+            skip = (page - 1) * per_page
+            characters = self.repository.search(query, skip=skip, limit=per_page, language=language)
+        else:
+            key = None
+            if cursor:
+                key = decode_cursor(cursor, text_value, int)
+            characters = self.repository.search_keyset(query, cursor=key, limit=per_page, language=language)
+        
+        next_cursor = None
+        if characters and len(characters) == per_page:
+            last = characters[-1]
+            next_cursor = encode_cursor(last.name, last.id)
+        return {"data": characters, "next_cursor": next_cursor}
 
     def get_characters_grouped_by_type(self, language: str = "en", limit_per_type: int = 10) -> Dict[str, List[Character]]:
         """Get characters grouped by their primary type"""
-        logger.info(f"Getting characters grouped by type for language: {language}")
+        logger.info("Getting characters grouped by type for language: %s", language)
         return self.repository.get_grouped_by_type(language, limit_per_type)
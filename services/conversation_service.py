@@ -1,45 +1,166 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Dict, Any
+from collections import deque
 from sqlalchemy.orm import Session
-from repositories.conversation_repository import ConversationRepository
+from sqlalchemy import update
+from datetime import datetime
+from repositories.conversation_repository import ConversationRepository, INSERT_MESSAGE
 from repositories.user_repository import UserRepository
 from repositories.character_repository import CharacterRepository
-from services.llm_service import LLMService
-from database.models import Conversation, Message, User
-from services.timing import time_db_operation, time_llm_operation, time_network_operation
+from services.llm_service import LLMConfig, get_llm_service
+from database.models import Conversation, Message, User, Character
+from database.db_utils import increment_counter
 import yaml
 import os
+import asyncio
+import string
 import logging
 
 # Set up logger
 logger = logging.getLogger(__name__)
 
+# Load prompts once at import rather than on every service instantiation,
+# with the libyaml-backed loader when PyYAML was built with it
+PROMPTS_PATH = os.path.join(os.path.dirname(__file__), 'prompts.yaml')
+with open(PROMPTS_PATH, 'r') as f:
+    PROMPTS = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+# Define supported languages
+SUPPORTED_LANGUAGES = frozenset([
+    "en",  # English
+    "es",  # Spanish
+    "pt",  # Portuguese
+    "ko",  # Korean
+    "ja",  # Japanese
+    "id",  # Indonesian
+    "fr",  # French
+    "de",  # German
+    "zh",  # Chinese
+    "hi",  # Hindi
+    "sw"   # Swahili
+])
+
+# Language strings as clients send them ("en", "EN", "en-US", ...) mapped to
+# the two-letter code, so the common case is a single dict lookup. Misses go
+# through _slow_normalize_language and are memoized up to a bound, since the
+# input comes straight from the client.
+LANGUAGE_ALIAS_MAX_ENTRIES = 1_000
+_LANG_ALIAS: Dict[str, str] = {}
+for _code in SUPPORTED_LANGUAGES:
+    for _variant in (_code, _code.upper(), _code.capitalize()):
+        _LANG_ALIAS[_variant] = _code
+for _locale in ("en-US", "en-GB", "es-ES", "es-MX", "pt-BR", "pt-PT", "ko-KR", "ja-JP",
+                "id-ID", "fr-FR", "de-DE", "zh-CN", "zh-TW", "hi-IN", "sw-KE"):
+    for _variant in (_locale, _locale.lower(), _locale.replace("-", "_"), _locale.lower().replace("-", "_")):
+        _LANG_ALIAS[_variant] = _locale[:2]
+
+def _slow_normalize_language(language: str) -> str:
+    """Lowercase, strip and drop the region part of a language string"""
+    normalized = language.lower().strip()
+    # Extract primary language code if it's in format like 'en-US'
+    if '-' in normalized:
+        normalized = normalized.split('-')[0]
+    if len(_LANG_ALIAS) < LANGUAGE_ALIAS_MAX_ENTRIES:
+        _LANG_ALIAS[language] = normalized
+    return normalized
+
+def normalize_language(language: str) -> str:
+    """Map a client language string to its primary language code"""
+    return _LANG_ALIAS.get(language) or _slow_normalize_language(language)
+
+def _compile_prompt(template: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    """
+    Split a str.format template into (literal, field name) pairs once, so
+    rendering is a join instead of re-parsing the format string per call
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if spec or conversion:
+            raise ValueError(f"Unsupported format spec in prompt field '{field}'")
+        parts.append((literal, field))
+    return tuple(parts)
+
+def render_prompt(parts: Tuple[Tuple[str, Optional[str]], ...], **values) -> str:
+    """Fill a compiled prompt; equivalent to template.format(**values)"""
+    return "".join(
+        literal if field is None else literal + str(values[field])
+        for literal, field in parts
+    )
+
+def _build_prompt_templates() -> dict:
+    """Map each supported language to its compiled system prompt template"""
+    templates = {}
+    for language in SUPPORTED_LANGUAGES:
+        prompt_key = f"CONVERSATION_SYSTEM_PROMPT_{language.upper()}"
+        if prompt_key in PROMPTS:
+            templates[language] = _compile_prompt(PROMPTS[prompt_key])
+        else:
+            # This shouldn't happen if the YAML is properly configured
+            logger.warning(f"Prompt key {prompt_key} not found despite language being supported")
+            templates[language] = _compile_prompt(PROMPTS["CONVERSATION_SYSTEM_PROMPT_EN"])
+    return templates
+
+PROMPT_BY_LANGUAGE = _build_prompt_templates()
+FALLBACK_PROMPT = _compile_prompt(PROMPTS["CONVERSATION_SYSTEM_PROMPT_REST"])
+
+# Sentinel the stream producer puts on the queue after the final write
+_STREAM_DONE = object()
+
+# Simple class for detached messages (avoids ORM dependency). The chat
+# payload dict is built once, when the message enters the history cache,
+# and reused by the LLM service on every later turn.
+class DetachedMessage:
+    __slots__ = ("role", "content", "payload")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+        self.payload = {"role": role, "content": content}
+
+# In-process cache of the LLM history window per conversation, so each turn
+# doesn't re-read the whole thread. Entries are validated against the newest
+# message id in the database, so writes from other workers are picked up.
+# The window grows by up to HISTORY_TRIM_STEP_MESSAGES before its oldest
+# messages are dropped in one go, so the prompt prefix sent to the provider
+# stays identical (and prefix-cached) for several turns at a time instead of
+# shifting by one message every turn.
+HISTORY_WINDOW_MESSAGES = LLMConfig().window_size * 2
+HISTORY_TRIM_STEP_MESSAGES = LLMConfig().window_step * 2
+HISTORY_CACHE_MAX_CONVERSATIONS = 10_000
+_history_cache: Dict[int, Dict[str, Any]] = {}
+
+def _put_history(conversation_id: int, entry: Dict[str, Any]) -> None:
+    """(Re-)insert a history entry so dict order tracks recency; evict the least recent when full"""
+    if len(_history_cache) >= HISTORY_CACHE_MAX_CONVERSATIONS:
+        _history_cache.pop(next(iter(_history_cache)), None)
+    _history_cache[conversation_id] = entry
+
+def remember_message(conversation_id: int, message_id: int, role: str, content: str) -> None:
+    """Add a newly written (or finalized) message to a cached history window"""
+    entry = _history_cache.get(conversation_id)
+    if entry is None:
+        return
+    if message_id == entry["last_id"] and entry["messages"]:
+        # Same message with its final content (e.g. after streaming)
+        entry["messages"][-1] = DetachedMessage(role, content)
+    elif message_id > entry["last_id"]:
+        messages = entry["messages"]
+        messages.append(DetachedMessage(role, content))
+        entry["last_id"] = message_id
+        if len(messages) > HISTORY_WINDOW_MESSAGES + HISTORY_TRIM_STEP_MESSAGES:
+            while len(messages) > HISTORY_WINDOW_MESSAGES:
+                messages.popleft()
+
 class ConversationService:
     def __init__(self, db: Session):
         self.db = db  # Store db reference for transactions
         self.repository = ConversationRepository(db)
         self.user_repository = UserRepository(db)
         self.character_repository = CharacterRepository(db)
-        self.llm_service = LLMService()
-        
-        # Load prompts
-        prompts_path = os.path.join(os.path.dirname(__file__), 'prompts.yaml')
-        with open(prompts_path, 'r') as f:
-            self.prompts = yaml.safe_load(f)
+        self.llm_service = get_llm_service()
         
-        # Define supported languages
-        self.supported_languages = [
-            "en",  # English
-            "es",  # Spanish
-            "pt",  # Portuguese
-            "ko",  # Korean
-            "ja",  # Japanese
-            "id",  # Indonesian
-            "fr",  # French
-            "de",  # German
-            "zh",   # Chinese
-            "hi",
-            "sw"
-        ]
+        # Shared, read-only module-level data
+        self.prompts = PROMPTS
+        self.supported_languages = SUPPORTED_LANGUAGES
     
     # @time_db_operation
     async def create_conversation(self, character_id: int, user_id: int, language: str = "en") -> Conversation:
@@ -52,75 +173,71 @@ class ConversationService:
             raise ValueError("Character not found")
         
         # Normalize language code
-        language = language.lower().strip()
-        # Extract primary language code if it's in format like 'en-US'
-        if '-' in language:
-            language = language.split('-')[0]
+        language = normalize_language(language)
         
         # Get system prompt template based on language
-        logger.info(f"Creating conversation with language: {language}")
+        logger.info("Creating conversation with language: %s", language)
         
         # Get character type as string (if multiple, use the first one)
         character_type = character.character_types[0] if character.character_types else "fictional_character"
         
-        if language in self.supported_languages:
-            prompt_key = f"CONVERSATION_SYSTEM_PROMPT_{language.upper()}"
-            system_prompt = self.prompts.get(prompt_key)
+        # One dict lookup picks the template; unsupported languages use the
+        # generic prompt, which also takes the language name
+        template = PROMPT_BY_LANGUAGE.get(language)
+        if template is None:
+            logger.info("Using fallback prompt for unsupported language: %s", language)
+            template = FALLBACK_PROMPT
+        system_prompt = render_prompt(
+            template,
+            character_name=character.name,
+            character_tagline=character.tagline,
+            character_type=character_type,
+            character_description=character.character_description,
+            language=language
+        )
+        
+        # Conversation, greeting messages and character stats go out in one transaction
+        try:
+            now = datetime.utcnow()
+            conversation = Conversation(
+                character_id=character_id,
+                creator_id=user_id,
+                system_message=system_prompt,
+                created_at=now,
+                updated_at=now
+            )
+            self.db.add(conversation)
+            self.db.flush()  # Assigns conversation.id
             
-            # If prompt exists for this language, use it
-            if system_prompt:
-                logger.info(f"Using specific prompt for language: {language}")
-                system_prompt = system_prompt.format(
-                    character_name=character.name,
-                    character_tagline=character.tagline,
-                    character_type=character_type,
-                    character_description=character.character_description
-                )
-            else:
-                # This shouldn't happen if the YAML is properly configured
-                logger.warning(f"Prompt key {prompt_key} not found despite language being supported")
-                system_prompt = self.prompts["CONVERSATION_SYSTEM_PROMPT_EN"].format(
-                    character_name=character.name,
-                    character_tagline=character.tagline,
-                    character_type=character_type,
-                    character_description=character.character_description
+            # Initial user greeting (needed for LLM context) and the character's
+            # greeting from their profile, inserted as a single executemany
+            greeting_rows = self.db.execute(INSERT_MESSAGE, [
+                {"conversation_id": conversation.id, "role": "user", "content": f"{character.name}!"},
+                {"conversation_id": conversation.id, "role": "assistant", "content": character.greeting}
+            ]).all()
+            
+            # Count the new conversation and the assistant greeting atomically
+            self.db.execute(
+                update(Character)
+                .where(Character.id == character_id)
+                .values(
+                    num_chats_created=Character.num_chats_created + 1,
+                    num_messages=Character.num_messages + 1
                 )
-        else:
-            # Fallback for unsupported languages
-            logger.info(f"Using fallback prompt for unsupported language: {language}")
-            system_prompt = self.prompts["CONVERSATION_SYSTEM_PROMPT_REST"].format(
-                character_name=character.name,
-                character_tagline=character.tagline,
-                character_type=character_type,
-                character_description=character.character_description, 
-                language=language
             )
+            
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
         
-        # Create conversation
-        conversation = self.repository.create({
-            "character_id": character_id,
-            "creator_id": user_id,
-            "system_message": system_prompt
+        # The first turn's history window is just the character greeting, so
+        # seed the cache with it instead of reading it back on that turn
+        _put_history(conversation.id, {
+            "last_id": greeting_rows[-1].id,
+            "messages": deque([DetachedMessage("assistant", character.greeting)])
         })
         
-        # Add initial user greeting (needed for LLM context)
-        user_content = f"{character.name}!"
-        user_message = self.repository.add_message(
-            conversation_id=conversation.id,
-            role="user",
-            content=user_content
-        )
-        
-        # Add character's greeting from their profile
-        ai_message = self.repository.add_message(
-            conversation_id=conversation.id,
-            role="assistant",
-            content=character.greeting
-        )
-        
-        # Update character stats to increment the conversation count
-        self.character_repository.update_stats(character_id, increment_chats=True)
-        
         return conversation
     
     # @time_db_operation
@@ -132,60 +249,77 @@ class ConversationService:
             ValueError: If conversation not found or user doesn't have access
             RuntimeError: If message processing fails
         """
-        # Get conversation and verify user has access
-        conversation = self.repository.get_by_id(conversation_id)
-        if not conversation:
+        # Get conversation and verify user has access in one query
+        context = self.repository.get_turn_context(conversation_id, user_id)
+        if not context:
             raise ValueError("Conversation not found")
             
-        if conversation.creator_id != user_id and user_id not in [p.id for p in conversation.participants]:
+        if not context.has_access:
             raise ValueError("User does not have access to this conversation")
         
-        # Check user credits
-        user = self.user_repository.get_by_id(user_id)
-        if user.credits < 1:
+        system_message = context.system_message
+        
+        # Charge the credit up front in one atomic UPDATE ... RETURNING, committed
+        # right away so the user row isn't locked for the length of the LLM call
+        if self.user_repository.try_consume_credit(user_id) is None:
             raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
+        self.db.commit()
         
         try:
             # Get conversation history before adding new message
-            history = self.get_conversation_messages(conversation_id)
+            history = self.get_history_window_at(conversation_id, context.latest_message_id)
+            
+            # Don't hold a pooled connection (or the read transaction) during the LLM call
+            self.db.close()
             
             # Get AI response using LLM service first
             ai_response = await self._generate_ai_response(
-                conversation.system_message,
+                system_message,
                 history,
-                message_content
+                message_content,
+                cache_key=str(conversation_id)
             )
             
-            # Only after successful LLM response, add both messages in a transaction
-            user_message = self.repository.add_message(
-                conversation_id=conversation_id,
-                role="user",
-                content=message_content
+            # Only after successful LLM response, add both messages in one INSERT
+            user_message, ai_message = self.repository.add_messages(
+                conversation_id,
+                [("user", message_content), ("assistant", ai_response)]
             )
             
-            ai_message = self.repository.add_message(
-                conversation_id=conversation_id,
-                role="assistant",
-                content=ai_response
-            )
-            
-            # Deduct credit after successful message exchange
-            user.credits -= 1
-            
-            # Commit the transaction
-            self.db.commit()
+            remember_message(conversation_id, user_message.id, "user", message_content)
+            remember_message(conversation_id, ai_message.id, "assistant", ai_response)
             
             return user_message, ai_message
             
         except Exception as e:
-            # Rollback on error
+            # Rollback on error and give the credit back
             self.db.rollback()
+            self.refund_credit(user_id)
             raise ValueError(f"Failed to process message: {str(e)}")
     
+    def refund_credit(self, user_id: int) -> None:
+        """Return a credit charged up front for a message exchange that failed"""
+        try:
+            increment_counter(self.db, "users", user_id, "credits")
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Failed to refund credit for user {user_id}: {str(e)}")
+    
+    def discard_reply(self, user_id: int, conversation_id: int, message_id: int) -> None:
+        """Drop the placeholder of a streamed reply that was never saved and return its credit"""
+        try:
+            self.repository.delete_message(conversation_id, message_id)
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Failed to discard message {message_id}: {str(e)}")
+        self.refund_credit(user_id)
+    
     # @time_llm_operation
-    async def _generate_ai_response(self, system_message: str, history: List[Message], user_message: str) -> str:
+    async def _generate_ai_response(self, system_message: str, history: List[Message], user_message: str, cache_key: Optional[str] = None) -> str:
         """Internal method to generate AI response, wrapped with timing decorator"""
-        return await self.llm_service.process_message(system_message, history, user_message)
+        return await self.llm_service.process_message(system_message, history, user_message, cache_key=cache_key)
     
     # @time_db_operation
     async def stream_user_message(self, user_id: int, conversation_id: int, message_content: str):
@@ -196,74 +330,151 @@ class ConversationService:
             ValueError: If conversation not found or user doesn't have access
             RuntimeError: If message processing fails
         """
-        # Get conversation and verify user has access
-        conversation = self.repository.get_by_id(conversation_id)
-        if not conversation:
+        # Get conversation and verify user has access in one query
+        context = self.repository.get_turn_context(conversation_id, user_id)
+        if not context:
             raise ValueError("Conversation not found")
             
-        if conversation.creator_id != user_id and user_id not in [p.id for p in conversation.participants]:
+        if not context.has_access:
             raise ValueError("User does not have access to this conversation")
         
-        # Check user credits
-        user = self.user_repository.get_by_id(user_id)
-        if user.credits < 1:
+        system_message = context.system_message
+        
+        # Charge the credit up front (see process_user_message)
+        if self.user_repository.try_consume_credit(user_id) is None:
             raise ValueError("Insufficient credits. Please purchase more credits to continue chatting.")
+        self.db.commit()
         
+        # Set once the producer has saved the reply; anything else (an error,
+        # or the consumer going away and this generator being closed) drops
+        # the placeholder and refunds the credit in the finally block
+        ai_message_id = None
+        settled = False
         try:
             # Get conversation history
-            history = self.get_conversation_messages(conversation_id)
+            history = self.get_history_window_at(conversation_id, context.latest_message_id)
             
-            # Save user message first
-            user_message = self.repository.add_message(
-                conversation_id=conversation_id,
-                role="user",
-                content=message_content
+            # Save user message and an empty AI message in one INSERT
+            user_message, ai_message = self.repository.add_messages(
+                conversation_id,
+                [("user", message_content), ("assistant", "")]
             )
+            user_message_id = user_message.id
+            ai_message_id = ai_message.id
             
-            # Initialize empty AI message
-            ai_message = self.repository.add_message(
-                conversation_id=conversation_id,
-                role="assistant",
-                content=""
-            )
+            # Hand the connection back to the pool for the length of the stream;
+            # the session checks out a fresh one for the final write
+            self.db.close()
             
-            # Stream AI response and accumulate content
-            accumulated_content = ""
+            # The producer drains the LLM and does the final write; this
+            # generator only relays tokens, so each one costs a put/get
+            queue: asyncio.Queue = asyncio.Queue()
+            producer = asyncio.create_task(self._drain_llm(
+                queue,
+                conversation_id,
+                system_message,
+                history,
+                message_content,
+                user_message_id,
+                ai_message_id
+            ))
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is _STREAM_DONE:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                if not producer.done():
+                    producer.cancel()
+                # The producer may have saved the reply even if the consumer
+                # left before reading the done sentinel
+                settled = producer.done() and not producer.cancelled() and producer.result()
+            
+        except Exception as e:
+            raise ValueError(f"Failed to process message: {str(e)}")
+        finally:
+            if not settled:
+                # Rollback and give the credit back, along with the empty
+                # AI message if it was already written
+                self.db.rollback()
+                if ai_message_id is None:
+                    self.refund_credit(user_id)
+                else:
+                    self.discard_reply(user_id, conversation_id, ai_message_id)
+    
+    async def _drain_llm(self, queue: asyncio.Queue, conversation_id: int, system_message: str,
+                         history: List[Message], message_content: str,
+                         user_message_id: int, ai_message_id: int) -> bool:
+        """
+        Producer for stream_user_message: puts tokens on the queue, then
+        writes the AI message in one commit and puts the done sentinel.
+        Errors are put on the queue for the consumer to raise.
+        Returns whether the AI message was saved.
+        """
+        try:
+            chunks = []
             async for token in self._stream_ai_response(
-                conversation.system_message,
+                system_message,
                 history,
-                message_content
+                message_content,
+                cache_key=str(conversation_id)
             ):
-                accumulated_content += token
-                # Update AI message content
-                ai_message.content = accumulated_content
-                yield token
+                chunks.append(token)
+                queue.put_nowait(token)
+            accumulated_content = "".join(chunks)
             
-            # Update final AI message and deduct credit
-            self.repository.update_message(ai_message.id, accumulated_content)
-            self.repository.update_last_chatted_with(conversation_id)
-            # Update message in memory too since we're still using it
-            ai_message.content = accumulated_content
-            user.credits -= 1
+            # Single final write of the AI message, preview and timestamp
+            self.repository.finalize_message(conversation_id, ai_message_id, accumulated_content)
             self.db.commit()
             
+            remember_message(conversation_id, user_message_id, "user", message_content)
+            remember_message(conversation_id, ai_message_id, "assistant", accumulated_content)
+            queue.put_nowait(_STREAM_DONE)
+            return True
         except Exception as e:
-            # Rollback on error
             self.db.rollback()
-            raise ValueError(f"Failed to process message: {str(e)}")
+            queue.put_nowait(e)
+            return False
     
     # @time_llm_operation
-    async def _stream_ai_response(self, system_message: str, history: List[Message], user_message: str):
+    async def _stream_ai_response(self, system_message: str, history: List[Message], user_message: str, cache_key: Optional[str] = None):
         """Internal method to stream AI response, wrapped with timing decorator"""
-        async for token in self.llm_service.stream_message(system_message, history, user_message):
+        async for token in self.llm_service.stream_message(system_message, history, user_message, cache_key=cache_key):
             yield token
     
     # @time_db_operation
-    def get_conversation_messages(self, conversation_id: int) -> List[Message]:
-        """Get all messages in a conversation except the initial user greeting"""
-        messages = self.repository.get_messages(conversation_id)
-        # Filter out the first message (user's "hello")
-        return messages[1:] if messages else []
+    def get_conversation_messages(self, conversation_id: int, limit: Optional[int] = None) -> List[Message]:
+        """
+        Get the messages in a conversation except the initial user greeting,
+        optionally only the most recent `limit` of them
+        """
+        return self.repository.get_messages(conversation_id, limit=limit, skip_first=True)
+    
+    def get_history_window_at(self, conversation_id: int, latest_id: Optional[int]) -> List[DetachedMessage]:
+        """
+        Get the most recent messages used as LLM context, excluding the
+        initial user greeting. latest_id is the conversation's newest message
+        id, as read by the caller; the in-process cache is used while it
+        still matches.
+        """
+        if latest_id is None:
+            return []
+        
+        entry = _history_cache.pop(conversation_id, None)
+        if entry is None or entry["last_id"] != latest_id:
+            # Fetch one extra row: the oldest one is either the initial greeting
+            # or already outside the window, so it is always dropped
+            rows = self.repository.get_recent_messages(conversation_id, HISTORY_WINDOW_MESSAGES + 1)
+            entry = {
+                "last_id": latest_id,
+                "messages": deque(DetachedMessage(row.role, row.content) for row in reversed(rows[:-1]))
+            }
+        
+        _put_history(conversation_id, entry)
+        return list(entry["messages"])
     
     # @time_db_operation
     def get_user_conversations(self, user_id: int) -> List[Conversation]:
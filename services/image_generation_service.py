@@ -1,18 +1,48 @@
 import os
-import requests
+import asyncio
+import httpx
 import base64
 from typing import Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+GETIMG_TEXT_TO_IMAGE_URL = "https://api.getimg.ai/v1/stable-diffusion-xl/text-to-image"
+GETIMG_TIMEOUT = httpx.Timeout(120.0, connect=5.0)  # SDXL generation is slow
+GETIMG_MAX_RETRIES = 3
+GETIMG_BACKOFF_SECONDS = 0.3
+# Only throttling and gateway errors are retried: a 500 may already have
+# produced (and billed) an image
+GETIMG_RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+# Shared async client so calls reuse keep-alive TCP/TLS connections to
+# getimg.ai and never block the event loop; closed on shutdown
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Get the shared getimg.ai client, creating it on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=GETIMG_TIMEOUT,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+        )
+    return _http_client
+
+async def close_image_generation_client() -> None:
+    """Close the shared getimg.ai client (called on shutdown)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 class ImageGenerationService:
     def __init__(self):
         self.api_key = os.getenv("GETIMG_API_KEY")
         if not self.api_key:
             raise ValueError("GETIMG_API_KEY environment variable not set")
             
-    def generate_image(
+    async def generate_image(
         self,
         prompt: str,
         width: int = 1024,
@@ -33,7 +63,7 @@ class ImageGenerationService:
         """
         try:
             logger.info("Preparing getimg.ai API request")
-            url = "https://api.getimg.ai/v1/stable-diffusion-xl/text-to-image"
+            url = GETIMG_TEXT_TO_IMAGE_URL
             
             headers = {
                 "Authorization": f"Bearer {self.api_key}",
@@ -53,7 +83,12 @@ class ImageGenerationService:
             }
             
             logger.info(f"Making API request to {url}")
-            response = requests.post(url, headers=headers, json=data)
+            client = _get_http_client()
+            for attempt in range(GETIMG_MAX_RETRIES + 1):
+                response = await client.post(url, headers=headers, json=data)
+                if response.status_code not in GETIMG_RETRY_STATUSES or attempt == GETIMG_MAX_RETRIES:
+                    break
+                await asyncio.sleep(GETIMG_BACKOFF_SECONDS * (2 ** attempt))
             
             if response.status_code != 200:
                 logger.error(f"API request failed with status {response.status_code}: {response.text}")
@@ -1,12 +1,31 @@
 import os
+import asyncio
 import cloudinary
 import cloudinary.uploader
 from typing import Optional
-import mimetypes
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Leading magic bytes of the accepted image formats
+IMAGE_SIGNATURES = (
+    (b'\xFF\xD8\xFF', 'image/jpeg'),
+    (b'\x89PNG\r\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'RIFF', 'image/webp'),  # RIFF container, confirmed by the WEBP tag below
+)
+
+def detect_image_type(image_data: bytes) -> Optional[str]:
+    """Return the MIME type of image_data from its signature, or None if unrecognized"""
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if image_data.startswith(signature):
+            # RIFF is also used by WAV/AVI; WebP carries its tag at bytes 8-12
+            if signature == b'RIFF' and image_data[8:12] != b'WEBP':
+                return None
+            return mime_type
+    return None
+
 class ImageService:
     def __init__(self):
         # Configure Cloudinary
@@ -17,7 +36,7 @@ class ImageService:
             secure=True
         )
     
-    def upload_character_image(self, image_data: bytes, character_id: int) -> Optional[str]:
+    async def upload_character_image(self, image_data: bytes, character_id: int) -> Optional[str]:
         """
         Upload a character image to Cloudinary
         Returns the URL of the uploaded image
@@ -25,31 +44,19 @@ class ImageService:
         try:
             logger.info(f"Starting image upload for character {character_id}")
             # Simple check for image data by looking at first few bytes
-            image_signatures = {
-                b'\xFF\xD8\xFF': 'image/jpeg',
-                b'\x89PNG\r\n': 'image/png',
-                b'GIF87a': 'image/gif',
-                b'GIF89a': 'image/gif',
-                b'RIFF': 'image/webp'  # WEBP starts with 'RIFF'
-            }
-            
-            is_valid_image = False
-            detected_type = None
-            for signature, mime_type in image_signatures.items():
-                if image_data.startswith(signature):
-                    is_valid_image = True
-                    detected_type = mime_type
-                    break
-                    
-            if not is_valid_image:
+            detected_type = detect_image_type(image_data)
+            if detected_type is None:
                 logger.error(f"Invalid image format. First few bytes: {image_data[:20].hex()}")
                 raise ValueError("Invalid image file format")
             
             logger.info(f"Valid image detected of type: {detected_type}")
             
-            # Upload to cloudinary with optimization
+            # Upload to cloudinary with optimization. The SDK is blocking, so it
+            # runs in a worker thread; it already reuses connections through its
+            # module-level urllib3 pool.
             logger.info("Starting Cloudinary upload...")
-            result = cloudinary.uploader.upload(
+            result = await asyncio.to_thread(
+                cloudinary.uploader.upload,
                 image_data,
                 public_id=f"character_{character_id}",
                 folder="characters",
@@ -1,7 +1,13 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Any, Tuple, Union
 from pydantic import BaseModel
 from openai import AsyncOpenAI
+import httpx
 import os
+import asyncio
+import orjson
+import hashlib
+from itertools import islice
+import time
 import logging
 from dotenv import load_dotenv
 from database.models import Message
@@ -9,11 +15,133 @@ from services.timing import time_network_operation
 
 logger = logging.getLogger(__name__)
 
+# Read .env and the API key once at import instead of on every LLMService
+load_dotenv()
+FIREWORKS_API_KEY = os.getenv("FIREWORKS_API_KEY")
+FIREWORKS_BASE_URL = "https://api.fireworks.ai/inference/v1"
+
+# Connection pool for the Fireworks client: keep enough warm connections for
+# bursts of concurrent chats so requests skip the TCP/TLS handshake, and
+# fail fast on connect while allowing slow generations to stream
+FIREWORKS_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60)
+FIREWORKS_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Admission control for Fireworks requests from this process, shared by every
+# LLMService. A burst beyond it waits here instead of piling onto the
+# provider and coming back as 429s. Streams hold a slot until the response
+# starts, not for their whole length.
+FIREWORKS_MAX_INFLIGHT = 64
+_inflight = asyncio.Semaphore(FIREWORKS_MAX_INFLIGHT)
+
+# Retries for the raw streaming request, which doesn't go through the SDK's
+# retry logic; only statuses returned before any token was streamed
+FIREWORKS_MAX_RETRIES = 2
+FIREWORKS_BACKOFF_SECONDS = 0.5
+FIREWORKS_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
 class LLMConfig(BaseModel):
     model: str = "accounts/fireworks/models/deepseek-v3"  # Correct format for Fireworks AI
     temperature: float = 0.6
     max_tokens: int = 150
     window_size: int = 12  # Number of message pairs (user + assistant) to keep
+    window_step: int = 4  # Pairs the window may grow past window_size before the oldest are dropped together
+    history_char_budget: int = 16_000  # Max characters of history sent, oldest dropped first
+    supports_cache_control: bool = False  # Mark the system prompt as cacheable (Anthropic-style providers)
+    max_concurrency: int = 16  # Max in-flight requests from one process_batch call
+    response_cache_enabled: bool = True  # Serve repeated short messages in the same context from the response cache
+
+# In-process cache of completions for short user messages. The key covers
+# the model settings and the whole windowed prompt (system message, history
+# and the normalized new message), so a hit is only possible when the model
+# would have seen exactly the same context, e.g. the same opener sent to a
+# character right after its fixed greeting.
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_SIZE = 10_000
+RESPONSE_CACHE_MAX_MESSAGE_LENGTH = 64
+_response_cache: Dict[str, Dict[str, Any]] = {}
+
+# Top-level checks for structured output, compiled once per schema object
+# (schemas are module constants, so identity is a stable key)
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+}
+SCHEMA_CHECK_CACHE_MAX_SIZE = 128
+_schema_checks: Dict[int, Tuple[Dict, Any]] = {}
+
+def _compile_schema_check(json_schema: Dict):
+    """Build a checker for required fields, property types and enums, returning an error or None"""
+    required = tuple(json_schema.get("required", ()))
+    rules = []
+    for name, spec in json_schema.get("properties", {}).items():
+        expected = _JSON_TYPES.get(spec.get("type"))
+        enum = frozenset(spec["enum"]) if "enum" in spec else None
+        if expected or enum:
+            rules.append((name, expected, enum))
+    
+    def check(value: Any) -> Optional[str]:
+        if not isinstance(value, dict):
+            return "expected a JSON object"
+        missing = [field for field in required if field not in value]
+        if missing:
+            return f"missing required fields {missing}"
+        for name, expected, enum in rules:
+            if name not in value:
+                continue
+            field = value[name]
+            # bool is an int subclass, but JSON true/false isn't a number
+            if expected and (not isinstance(field, expected) or (expected is not bool and isinstance(field, bool))):
+                return f"field '{name}' has the wrong type"
+            if enum is not None and (isinstance(field, (dict, list)) or field not in enum):
+                return f"field '{name}' is not one of the allowed values"
+        return None
+    
+    return check
+
+def _schema_check(json_schema: Dict):
+    """Compiled checker for a schema, cached by schema identity"""
+    entry = _schema_checks.get(id(json_schema))
+    if entry is None or entry[0] is not json_schema:
+        entry = (json_schema, _compile_schema_check(json_schema))
+        if len(_schema_checks) >= SCHEMA_CHECK_CACHE_MAX_SIZE:
+            _schema_checks.pop(next(iter(_schema_checks)), None)
+        _schema_checks[id(json_schema)] = entry
+    return entry[1]
+
+# Process-wide token usage of chat completions, including how many prompt
+# tokens the provider served from its prefix cache
+_usage_totals = {"responses": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+
+def _usage_field(usage: Any, name: str) -> Any:
+    """Field of a usage block, whether it came from the SDK (object) or raw JSON (dict)"""
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+def _record_usage(usage: Any) -> None:
+    """Add one response's usage block to the running totals"""
+    details = _usage_field(usage, "prompt_tokens_details")
+    cached = (_usage_field(details, "cached_tokens") if details else None) or 0
+    prompt_tokens = _usage_field(usage, "prompt_tokens") or 0
+    completion_tokens = _usage_field(usage, "completion_tokens") or 0
+    _usage_totals["responses"] += 1
+    _usage_totals["prompt_tokens"] += prompt_tokens
+    _usage_totals["cached_prompt_tokens"] += cached
+    _usage_totals["completion_tokens"] += completion_tokens
+    logger.debug("LLM usage: %d prompt tokens (%d cached), %d completion tokens",
+                 prompt_tokens, cached, completion_tokens)
+
+def get_usage_stats() -> Dict[str, Any]:
+    """Token usage totals for this process and the share of prompt tokens served from cache"""
+    prompt_tokens = _usage_totals["prompt_tokens"]
+    return {
+        **_usage_totals,
+        "prompt_cache_hit_ratio": _usage_totals["cached_prompt_tokens"] / prompt_tokens if prompt_tokens else 0.0
+    }
 
 class LLMResponse(BaseModel):
     content: str
@@ -21,24 +149,129 @@ class LLMResponse(BaseModel):
     completion_id: str
 
 class LLMService:
-    def __init__(self, config: Optional[LLMConfig] = None):
+    def __init__(
+        self,
+        config: Optional[LLMConfig] = None,
+        client: Optional[AsyncOpenAI] = None,
+        http_client: Optional[httpx.AsyncClient] = None
+    ):
         self.config = config or LLMConfig()
-        # Load environment variables
-        load_dotenv()
-        
-        # Validate API key - only need Fireworks API key now
-        if not os.getenv("FIREWORKS_API_KEY"):
-            logger.error("FIREWORKS_API_KEY not found in environment variables")
-            raise ValueError("FIREWORKS_API_KEY not set")
+        self._window_messages = (self.config.window_size + self.config.window_step) * 2  # user + assistant per pair
         
-        # Create OpenAI client with Fireworks API base
-        self.client = AsyncOpenAI(
-            api_key=os.getenv("FIREWORKS_API_KEY"),
-            base_url="https://api.fireworks.ai/inference/v1"
-        )
+        # Share an existing client (and its connection pool) when given one;
+        # the raw streaming path needs the HTTP client underneath it as well
+        if client is None:
+            # Validate API key - only need Fireworks API key now
+            if not FIREWORKS_API_KEY:
+                logger.error("FIREWORKS_API_KEY not found in environment variables")
+                raise ValueError("FIREWORKS_API_KEY not set")
+            
+            # Create OpenAI client with Fireworks API base on a tuned, pooled
+            # HTTP client that is reused for every request
+            http_client = httpx.AsyncClient(
+                limits=FIREWORKS_HTTP_LIMITS,
+                timeout=FIREWORKS_HTTP_TIMEOUT
+            )
+            client = AsyncOpenAI(
+                api_key=FIREWORKS_API_KEY,
+                base_url=FIREWORKS_BASE_URL,
+                http_client=http_client
+            )
+        elif http_client is None:
+            raise ValueError("http_client is required when passing a client")
+        self.client = client
+        self._http = http_client
+        self._create = client.chat.completions.create
+        self._completions_url = f"{str(client.base_url).rstrip('/')}/chat/completions"
+        self._auth_header = f"Bearer {client.api_key}"
         
         # logger.info(f"LLM Service initialized with model: {self.config.model}")
 
+    def _response_cache_key(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Cache key for a windowed prompt, or None if it isn't worth caching"""
+        if not self.config.response_cache_enabled:
+            return None
+        new_message = messages[-1]["content"]
+        if len(new_message) > RESPONSE_CACHE_MAX_MESSAGE_LENGTH:
+            return None
+        normalized = messages[:-1] + [{"role": "user", "content": " ".join(new_message.lower().split())}]
+        payload = orjson.dumps(
+            [self.config.model, self.config.temperature, self.config.max_tokens, normalized]
+        )
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def _get_cached_response(self, key: Optional[str]) -> Optional[str]:
+        """Return a cached completion, or None if missing or expired"""
+        if key is None:
+            return None
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] <= time.time():
+            _response_cache.pop(key, None)
+            return None
+        return entry["data"]
+
+    def _cache_response(self, key: Optional[str], content: str) -> None:
+        """Cache a completion, evicting the oldest entry when full"""
+        if key is None or not content:
+            return
+        if key not in _response_cache and len(_response_cache) >= RESPONSE_CACHE_MAX_SIZE:
+            # Dicts preserve insertion order, so the first key is the oldest
+            _response_cache.pop(next(iter(_response_cache)), None)
+        _response_cache[key] = {
+            "data": content,
+            "expires": time.time() + RESPONSE_CACHE_TTL_SECONDS
+        }
+
+    def with_config(self, config: LLMConfig) -> "LLMService":
+        """A service with different model settings on this one's clients and connection pool"""
+        return LLMService(config, client=self.client, http_client=self._http)
+
+    async def _complete(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **extra) -> Any:
+        """Send a chat completion request with the configured model settings"""
+        async with _inflight:
+            return await self._create(
+                model=model or self.config.model,
+                messages=messages,
+                temperature=self.config.temperature,
+                max_tokens=self.config.max_tokens,
+                **extra
+            )
+
+    @staticmethod
+    def _extract_content(response: Any) -> str:
+        """Content of a non-streaming completion, or RuntimeError if it has none"""
+        if not response or not response.choices or not response.choices[0].message:
+            logger.error("Received invalid response from LLM")
+            raise RuntimeError("Invalid response from language model")
+        return response.choices[0].message.content
+
+    def _cache_headers(self, cache_key: Optional[str]) -> Optional[Dict[str, str]]:
+        """
+        Headers that route requests sharing a cache key to the same replica.
+        Fireworks caches prompt prefixes automatically; affinity is what makes
+        the (verbatim-stable) system prompt of a conversation hit that cache
+        on every turn after the first.
+        """
+        if not cache_key:
+            return None
+        return {"x-session-affinity": cache_key}
+
+    def _system_entry(self, system_prompt: str) -> Dict[str, Any]:
+        """
+        System message for a request. System prompts are fixed (per
+        conversation, or per feature like moderation) and always sent first,
+        so providers with automatic prefix caching (Fireworks) reuse them as
+        is; providers that need an explicit marker get one.
+        """
+        if self.config.supports_cache_control:
+            return {
+                "role": "system",
+                "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+            }
+        return {"role": "system", "content": system_prompt}
+
     def _get_windowed_messages(
         self,
         system_message: str,
@@ -46,20 +279,30 @@ class LLMService:
         new_message: str
     ) -> List[Dict[str, str]]:
         """
-        Get windowed conversation messages, keeping system prompt and last N pairs
+        Get windowed conversation messages, keeping system prompt and last N pairs,
+        then dropping the oldest of those until the history fits the character budget
         """
-        messages = [{"role": "system", "content": system_message}]
+        messages = [self._system_entry(system_message)]
         
-        # Calculate how many message pairs to keep
-        window_size = self.config.window_size * 2  # Multiply by 2 for user + assistant pairs
+        # One backward pass picks where the window starts: at most the last
+        # N messages, and only as many of those as fit the character budget,
+        # so the length of a few very long messages can't push every turn
+        # towards the context limit
+        budget = self.config.history_char_budget
+        floor = max(0, len(conversation_history) - self._window_messages)
+        total_chars = 0
+        start = len(conversation_history)
+        while start > floor:
+            total_chars += len(conversation_history[start - 1].content or "")
+            if total_chars > budget:
+                break
+            start -= 1
         
-        # If we have more messages than our window, slice the history
-        if len(conversation_history) > window_size:
-            conversation_history = conversation_history[-window_size:]
-        
-        # Add conversation history
-        for msg in conversation_history:
-            messages.append({
+        # Add conversation history, reusing prebuilt payloads where the
+        # history comes from the cache
+        for msg in islice(conversation_history, start, None):
+            payload = getattr(msg, "payload", None)
+            messages.append(payload if payload is not None else {
                 "role": msg.role,
                 "content": msg.content
             })
@@ -70,10 +313,11 @@ class LLMService:
             "content": new_message
         })
         
-        # Log windowed messages
-        # logger.info(f"Using {len(messages)-1} messages from history (window_size={self.config.window_size} pairs)")
-        # for i, msg in enumerate(messages):
-        #     logger.info(f"Message {i}: role={msg['role']}, content={msg['content'][:50]}...")
+        # Log windowed messages; the per-message dump only runs with DEBUG on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Using %d messages from history (window_size=%d pairs)", len(messages) - 1, self.config.window_size)
+            for i, msg in enumerate(messages):
+                logger.debug("Message %d: role=%s, content=%.50s...", i, msg["role"], msg["content"])
             
         return messages
 
@@ -83,6 +327,7 @@ class LLMService:
         system_message: str,
         conversation_history: List[Message],
         new_message: str,
+        cache_key: Optional[str] = None,
     ) -> str:
         """
         Process a message in the context of a conversation with a character
@@ -90,6 +335,7 @@ class LLMService:
             system_message: The character's system prompt
             conversation_history: List of previous messages
             new_message: The user's new message
+            cache_key: Stable per-conversation key for prompt cache affinity
         Returns:
             The AI's response
         """
@@ -97,22 +343,22 @@ class LLMService:
             # Get windowed messages
             messages = self._get_windowed_messages(system_message, conversation_history, new_message)
             
-            # logger.info(f"Sending request to LLM with {len(messages)} messages")
+            # Same short message in the same context: answer from the cache
+            response_key = self._response_cache_key(messages)
+            cached = self._get_cached_response(response_key)
+            if cached is not None:
+                return cached
+            
+            logger.info("Sending request to LLM with %d messages", len(messages))
             
             # Call LLM with Fireworks parameters using OpenAI client
-            response = await self.client.chat.completions.create(
-                model=self.config.model,
-                messages=messages,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens
-            )
+            response = await self._complete(messages, extra_headers=self._cache_headers(cache_key))
             
-            # Extract and return response
-            if not response or not response.choices or not response.choices[0].message:
-                logger.error("Received invalid response from LLM")
-                raise RuntimeError("Invalid response from language model")
-                
-            return response.choices[0].message.content
+            content = self._extract_content(response)
+            if response.usage is not None:
+                _record_usage(response.usage)
+            self._cache_response(response_key, content)
+            return content
             
         except Exception as e:
             logger.error(f"Error in LLM service: {str(e)}")
@@ -124,6 +370,7 @@ class LLMService:
         system_message: str,
         conversation_history: List[Message],
         new_message: str,
+        cache_key: Optional[str] = None,
     ):
         """
         Stream a message response token by token
@@ -131,6 +378,7 @@ class LLMService:
             system_message: The character's system prompt
             conversation_history: List of previous messages
             new_message: The user's new message
+            cache_key: Stable per-conversation key for prompt cache affinity
         Yields:
             Tokens from the AI's response
         """
@@ -138,28 +386,87 @@ class LLMService:
             # Get windowed messages
             messages = self._get_windowed_messages(system_message, conversation_history, new_message)
             
-            # logger.info(f"Starting streaming request to LLM with {len(messages)} messages")
+            # Same short message in the same context: answer from the cache
+            response_key = self._response_cache_key(messages)
+            cached = self._get_cached_response(response_key)
+            if cached is not None:
+                yield cached
+                return
             
-            # Call LLM with streaming and Fireworks parameters using OpenAI client
-            response = await self.client.chat.completions.create(
-                model=self.config.model,
-                messages=messages,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                stream=True
-            )
+            logger.info("Starting streaming request to LLM with %d messages", len(messages))
+            
+            # Stream over the shared HTTP client directly: only delta.content
+            # is needed, so each SSE line is parsed once with orjson instead of
+            # being built into SDK models
+            body = orjson.dumps({
+                "model": self.config.model,
+                "messages": messages,
+                "temperature": self.config.temperature,
+                "max_tokens": self.config.max_tokens,
+                "stream": True,
+                "stream_options": {"include_usage": True}
+            })
+            headers = {
+                "Authorization": self._auth_header,
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+                **(self._cache_headers(cache_key) or {})
+            }
+            response = await self._open_stream(body, headers)
             
-            async for chunk in response:
-                if chunk and chunk.choices and chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            chunks = []
+            append = chunks.append
+            try:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = orjson.loads(data)
+                    choices = chunk.get("choices")
+                    token = choices[0].get("delta", {}).get("content") if choices else None
+                    if token:
+                        append(token)
+                        yield token
+                    elif chunk.get("error"):
+                        raise RuntimeError(str(chunk["error"]))
+                    elif chunk.get("usage"):
+                        _record_usage(chunk["usage"])
+            finally:
+                await response.aclose()
+            self._cache_response(response_key, "".join(chunks))
                     
         except Exception as e:
             logger.error(f"Error in LLM streaming service: {str(e)}")
             raise RuntimeError(f"Failed to stream message: {str(e)}")
 
+    async def _open_stream(self, body: bytes, headers: Dict[str, str]) -> httpx.Response:
+        """
+        POST a streaming completion and return the open response once it
+        starts, retrying throttling and server errors with backoff
+        """
+        for attempt in range(FIREWORKS_MAX_RETRIES + 1):
+            request = self._http.build_request("POST", self._completions_url, content=body, headers=headers)
+            async with _inflight:
+                response = await self._http.send(request, stream=True)
+            if response.status_code == 200:
+                return response
+            
+            detail = (await response.aread())[:500].decode(errors="replace")
+            await response.aclose()
+            if response.status_code not in FIREWORKS_RETRY_STATUSES or attempt == FIREWORKS_MAX_RETRIES:
+                raise RuntimeError(f"LLM API returned {response.status_code}: {detail}")
+            await asyncio.sleep(FIREWORKS_BACKOFF_SECONDS * (2 ** attempt))
+
+    async def aclose(self) -> None:
+        """Close the client and its pooled connections"""
+        await self.client.close()
+
     def update_config(self, new_config: LLMConfig):
         """Update the LLM configuration"""
         self.config = new_config
+        self._window_messages = (new_config.window_size + new_config.window_step) * 2
         
     async def process_single_prompt(
         self,
@@ -177,29 +484,38 @@ class LLMService:
         try:
             # Create messages array with system and user messages
             messages = [
-                {"role": "system", "content": system_prompt},
+                self._system_entry(system_prompt),
                 {"role": "user", "content": user_prompt}
             ]
             
             # Call LLM with Fireworks parameters using OpenAI client
-            response = await self.client.chat.completions.create(
-                model=self.config.model,
-                messages=messages,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens
-            )
-            
-            # Extract and return response
-            if not response or not response.choices or not response.choices[0].message:
-                logger.error("Received invalid response from LLM")
-                raise RuntimeError("Invalid response from language model")
-                
-            return response.choices[0].message.content
+            response = await self._complete(messages)
+            return self._extract_content(response)
             
         except Exception as e:
             logger.error(f"Error in LLM service single prompt: {str(e)}")
             raise RuntimeError(f"Failed to process prompt: {str(e)}")
             
+    async def process_batch(self, items: List[Tuple[str, str]]) -> List[Union[str, Exception]]:
+        """
+        Process independent (system_prompt, user_prompt) pairs concurrently
+        Args:
+            items: The prompt pairs
+        Returns:
+            One result per pair, in order: the LLM's response, or the
+            exception raised for that pair
+        """
+        semaphore = asyncio.Semaphore(self.config.max_concurrency)
+        
+        async def run(system_prompt: str, user_prompt: str) -> str:
+            async with semaphore:
+                return await self.process_single_prompt(system_prompt, user_prompt)
+        
+        return await asyncio.gather(
+            *(run(system_prompt, user_prompt) for system_prompt, user_prompt in items),
+            return_exceptions=True
+        )
+
     async def process_structured_output(
         self,
         system_prompt: str,
@@ -222,7 +538,7 @@ class LLMService:
         try:
             # Create messages array with system and user messages
             messages = [
-                {"role": "system", "content": system_prompt},
+                self._system_entry(system_prompt),
                 {"role": "user", "content": user_prompt}
             ]
             
@@ -232,34 +548,44 @@ class LLMService:
                 "schema": json_schema
             }
             
-            # Use a specific model if provided, otherwise use the configured model
-            model_to_use = model or self.config.model
-            
-            # Call LLM with structured output parameters
-            response = await self.client.chat.completions.create(
-                model=model_to_use,
-                messages=messages,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                response_format=response_format
-            )
-            
-            # Extract and parse the response
-            if not response or not response.choices or not response.choices[0].message:
-                logger.error("Received invalid response from LLM")
-                raise RuntimeError("Invalid response from language model")
-                
-            content = response.choices[0].message.content
+            # Call LLM with structured output parameters, on a specific model
+            # if provided, otherwise the configured one
+            response = await self._complete(messages, model=model, response_format=response_format)
+            content = self._extract_content(response)
             
             # Parse the JSON response
-            import json
             try:
-                parsed_response = json.loads(content)
-                return parsed_response
-            except json.JSONDecodeError:
+                parsed_response = orjson.loads(content)
+            except orjson.JSONDecodeError:
                 logger.error(f"Failed to parse JSON response: {content}")
                 raise RuntimeError("LLM response was not valid JSON")
             
+            # In strict mode check the top level against the schema
+            if strict:
+                error = _schema_check(json_schema)(parsed_response)
+                if error:
+                    raise RuntimeError(f"LLM response does not match schema: {error}")
+            
+            return parsed_response
+            
         except Exception as e:
             logger.error(f"Error in LLM service structured output: {str(e)}")
-            raise RuntimeError(f"Failed to process structured output: {str(e)}")
\ No newline at end of file
+            raise RuntimeError(f"Failed to process structured output: {str(e)}")
+# Process-wide instance with the default config. Sharing it means one
+# AsyncOpenAI client, so its httpx connection pool (and keep-alive
+# connections to the provider) is reused across requests.
+_default_llm_service: Optional[LLMService] = None
+
+def get_llm_service() -> LLMService:
+    """Get the shared LLMService, creating it on first use"""
+    global _default_llm_service
+    if _default_llm_service is None:
+        _default_llm_service = LLMService()
+    return _default_llm_service
+
+async def close_llm_service() -> None:
+    """Close the shared client's connections (called on shutdown)"""
+    global _default_llm_service
+    if _default_llm_service is not None:
+        await _default_llm_service.aclose()
+        _default_llm_service = None
@@ -1,10 +1,73 @@
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, Optional
+import hashlib
 import logging
 import os
-from services.llm_service import LLMService, LLMConfig
+import time
+from services.llm_service import LLMService, LLMConfig, get_llm_service
 
 logger = logging.getLogger(__name__)
 
+# Moderation only has to produce a three-field verdict, so it runs on a small,
+# fast model with a tight output budget. An unusable verdict from it (bad
+# JSON, schema mismatch, cut off by max_tokens) is retried once on the
+# larger model.
+MODERATION_MODEL = os.getenv("MODERATION_MODEL", "accounts/fireworks/models/llama-v3p1-8b-instruct")
+MODERATION_FALLBACK_MODEL = os.getenv("MODERATION_FALLBACK_MODEL", "accounts/fireworks/models/deepseek-v3")
+MODERATION_MAX_TOKENS = 96
+
+# System prompt explaining moderation guidelines (fixed, so built once at import)
+MODERATION_SYSTEM_PROMPT = """
+You are a content moderator for a character-based AI chat platform. Your job is to review character descriptions
+and determine if they violate our community guidelines.
+
+MODERATION GUIDELINES:
+- ALLOW sensual descriptions and flirtatious content (as long as it's not explicit)
+- ALLOW fictional violence, mild profanity, and mature themes when appropriate
+- ALLOW things that are objectifying, focus excessively and even problematically, just nothing extremely explicit
+- REJECT extreme racist or hateful content
+- REJECT extremely sexist or discriminatory content
+- REJECT content that explicitly describes nudity or sexual acts
+- REJECT content that promotes illegal activities
+- REJECT content likely to generate problematic AI images
+
+DEFAULT TO APPROVING content unless it clearly violates the guidelines. We want to allow creative expression and
+mature themes while ensuring a safe environment. DON'T REJECT UNLESS IT VERY EXPLICITLY VIOLATES GUIDELINES.
+"""
+
+# JSON schema for the moderation verdict
+MODERATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "approved": {
+            "type": "boolean",
+            "description": "Whether the character should be approved (true) or rejected (false)"
+        },
+        "reason": {
+            "type": "string",
+            "description": "One short sentence explaining why the character was approved or rejected"
+        },
+        "category": {
+            "type": "string",
+            "enum": ["hate_speech", "sexual_content", "violence", "illegal_activity", "other", "none"],
+            "description": "Category of violation if rejected, 'none' if approved"
+        }
+    },
+    "required": ["approved", "reason", "category"]
+}
+
+# Approvals are cached so resubmitting the same character (retries, edits
+# saved without changes) skips the LLM. Rejections and fail-open defaults are
+# never cached. Bump MODERATION_POLICY_VERSION when the prompt or schema
+# changes, so earlier verdicts stop matching.
+MODERATION_POLICY_VERSION = 1
+MODERATION_CACHE_TTL_SECONDS = 3600
+MODERATION_CACHE_MAX_SIZE = 10_000
+_approval_cache: Dict[bytes, Dict[str, Any]] = {}
+
+def _approval_key(user_prompt: str) -> bytes:
+    """Cache key for a submission under the current moderation policy"""
+    return hashlib.blake2b(f"{MODERATION_POLICY_VERSION}\x1f{user_prompt}".encode(), digest_size=16).digest()
+
 class ModerationResult:
     """Result of content moderation check"""
     def __init__(self, approved: bool, reason: str = "", category: str = ""):
@@ -20,15 +83,16 @@ class ModerationService:
     
     def __init__(self, llm_service: Optional[LLMService] = None):
         """Initialize the moderation service"""
-        # Use a GPT-4o-mini model specifically for moderation
+        # Use a small model specifically for moderation
         moderation_config = LLMConfig(
-            model="accounts/fireworks/models/deepseek-v3", 
+            model=MODERATION_MODEL,
             temperature=0.1,  # Low temperature for more consistent results
-            max_tokens=200
+            max_tokens=MODERATION_MAX_TOKENS
         )
         
-        # Create LLM service or use provided one
-        self.llm_service = llm_service or LLMService(moderation_config)
+        # Use the provided LLM service or one with the moderation settings
+        # that shares the app-wide client
+        self.llm_service = llm_service or get_llm_service().with_config(moderation_config)
         logger.info("Moderation service initialized")
         
     async def moderate_character(
@@ -58,25 +122,6 @@ Greeting: {greeting}
 Tagline: {tagline or ''}
 """
         
-        # System prompt explaining moderation guidelines
-        system_prompt = """
-You are a content moderator for a character-based AI chat platform. Your job is to review character descriptions
-and determine if they violate our community guidelines.
-
-MODERATION GUIDELINES:
-- ALLOW sensual descriptions and flirtatious content (as long as it's not explicit)
-- ALLOW fictional violence, mild profanity, and mature themes when appropriate
-- ALLOW things that are objectifying, focus excessively and even problematically, just nothing extremely explicit
-- REJECT extreme racist or hateful content
-- REJECT extremely sexist or discriminatory content
-- REJECT content that explicitly describes nudity or sexual acts
-- REJECT content that promotes illegal activities
-- REJECT content likely to generate problematic AI images
-
-DEFAULT TO APPROVING content unless it clearly violates the guidelines. We want to allow creative expression and
-mature themes while ensuring a safe environment. DON'T REJECT UNLESS IT VERY EXPLICITLY VIOLATES GUIDELINES.
-"""
-
         user_prompt = f"""
 Please review this character submission and determine if it should be approved or rejected:
 
@@ -85,35 +130,29 @@ Please review this character submission and determine if it should be approved o
 Provide a structured judgment following our guidelines.
 """
 
-        # Define the JSON schema for the response
-        json_schema = {
-            "type": "object",
-            "properties": {
-                "approved": {
-                    "type": "boolean",
-                    "description": "Whether the character should be approved (true) or rejected (false)"
-                },
-                "reason": {
-                    "type": "string",
-                    "description": "Explanation for why the character was approved or rejected"
-                },
-                "category": {
-                    "type": "string",
-                    "enum": ["hate_speech", "sexual_content", "violence", "illegal_activity", "other", "none"],
-                    "description": "Category of violation if rejected, 'none' if approved"
-                }
-            },
-            "required": ["approved", "reason", "category"]
-        }
+        approval_key = _approval_key(user_prompt)
+        cached = _approval_cache.get(approval_key)
+        if cached is not None and cached["expires"] > time.time():
+            logger.debug("Character '%s' approved (cached)", name)
+            return cached["data"]
 
         try:
             # Use the structured output method from LLM service
-            response = await self.llm_service.process_structured_output(
-                system_prompt=system_prompt,
-                user_prompt=user_prompt,
-                json_schema=json_schema,
-                model="accounts/fireworks/models/deepseek-v3"  # Use GPT-4o-mini equivalent
-            )
+            try:
+                response = await self.llm_service.process_structured_output(
+                    system_prompt=MODERATION_SYSTEM_PROMPT,
+                    user_prompt=user_prompt,
+                    json_schema=MODERATION_SCHEMA,
+                    model=MODERATION_MODEL
+                )
+            except RuntimeError as e:
+                logger.warning("Moderation model failed (%s), retrying on %s", e, MODERATION_FALLBACK_MODEL)
+                response = await self.llm_service.process_structured_output(
+                    system_prompt=MODERATION_SYSTEM_PROMPT,
+                    user_prompt=user_prompt,
+                    json_schema=MODERATION_SCHEMA,
+                    model=MODERATION_FALLBACK_MODEL
+                )
             
             # Create result from response
             result = ModerationResult(
@@ -123,9 +162,12 @@ Provide a structured judgment following our guidelines.
             )
             
             if not result.approved:
-                logger.info(f"Character '{name}' rejected: {result.reason} (Category: {result.category})")
+                logger.info("Character '%s' rejected: %s (Category: %s)", name, result.reason, result.category)
             else:
-                logger.debug(f"Character '{name}' approved")
+                logger.debug("Character '%s' approved", name)
+                if len(_approval_cache) >= MODERATION_CACHE_MAX_SIZE:
+                    _approval_cache.pop(next(iter(_approval_cache)), None)
+                _approval_cache[approval_key] = {"data": result, "expires": time.time() + MODERATION_CACHE_TTL_SECONDS}
                 
             return result
             
@@ -1,11 +1,30 @@
 import os
+import copy
+import logging
+import time
+import asyncio
 import secrets
 import httpx
-from typing import Dict, Any, List, Optional, Tuple
-from decimal import Decimal
+import orjson
+from typing import Dict, Any, List, Optional, Tuple, Union
+from decimal import Decimal, ROUND_HALF_EVEN
+from dotenv import load_dotenv
 
 from repositories.payment_repository import PaymentRepository
 
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Payment configuration, read once at import rather than on every request
+PAYMENT_RECIPIENT_ADDRESS = os.getenv("PAYMENT_RECIPIENT_ADDRESS")
+WORLD_ID_APP_ID = os.getenv("WORLD_ID_APP_ID")
+DEV_PORTAL_API_KEY = os.getenv("DEV_PORTAL_API_KEY")
+
+# Headers and query params for the Developer Portal transaction lookups
+_AUTH_HEADERS = {"Authorization": f"Bearer {DEV_PORTAL_API_KEY}"}
+_TX_PARAMS = {"app_id": WORLD_ID_APP_ID, "type": "payment"}
+
 # Constants
 TOKEN_DECIMALS = {
     "USDC.e": 6,
@@ -21,6 +40,52 @@ WORLD_API_TOKEN_MAPPING = {
     "USDC.e": "USDCE"
 }
 
+# Precomputed at import: the scale factor per token and the reverse of the
+# API name mapping, so conversions and price unpacking are dict lookups
+TOKEN_FACTORS = {token: 10 ** decimals for token, decimals in TOKEN_DECIMALS.items()}
+API_TO_INTERNAL_TOKEN = {api_name: token for token, api_name in WORLD_API_TOKEN_MAPPING.items()}
+
+# Shared client for the World App / Developer Portal APIs, so price and
+# transaction lookups reuse keep-alive connections instead of opening a new
+# TCP/TLS connection per call; closed on shutdown
+WORLD_API_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Get the shared World API client, creating it on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=WORLD_API_TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    return _http_client
+
+async def close_payment_client() -> None:
+    """Close the shared World API client (called on shutdown)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# Token prices move on a seconds timescale, so a short TTL collapses repeated
+# lookups (mostly the same WLD/USDC.e in USD query) into one API call.
+# Bounded because the fiat currency list comes from the client.
+TOKEN_PRICE_CACHE_TTL_SECONDS = 15
+TOKEN_PRICE_CACHE_MAX_SIZE = 256
+_price_cache: Dict[tuple, Dict[str, Any]] = {}
+_price_fetches: Dict[tuple, "asyncio.Future"] = {}
+
+# Per-credit token rate derived from those prices, cached for the same TTL
+# so quoting a non-WLD purchase is a single multiplication on a hit
+WLD_PER_CREDIT = 0.01  # 0.1 WLD for 10 credits
+_rate_cache: Dict[str, Dict[str, Any]] = {}
+
+async def _db(fn, *args, **kwargs):
+    """Run a synchronous PaymentRepository call in a worker thread so the
+    blocking database round trip doesn't stall the event loop"""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
 class PaymentService:
     """Service for handling payment operations with World ID MiniKit"""
     
@@ -39,43 +104,67 @@ class PaymentService:
         Returns:
             Dictionary of price information
         """
+        # Served from a short-lived cache; concurrent misses for the same
+        # query share a single fetch
+        key = (tuple(sorted(crypto_currencies)), tuple(sorted(fiat_currencies)))
+        cached = _price_cache.get(key)
+        if cached is not None and cached["expires"] > time.monotonic():
+            return copy.deepcopy(cached["data"])
+        
+        fetch = _price_fetches.get(key)
+        if fetch is None:
+            fetch = asyncio.ensure_future(PaymentService._fetch_token_prices(key, crypto_currencies, fiat_currencies))
+            _price_fetches[key] = fetch
+            fetch.add_done_callback(lambda _: _price_fetches.pop(key, None))
+        
+        # Shielded so one caller going away doesn't cancel the fetch for the rest
+        result = await asyncio.shield(fetch)
+        return copy.deepcopy(result)
+    
+    @staticmethod
+    async def _fetch_token_prices(key: tuple, crypto_currencies: List[str], fiat_currencies: List[str]) -> Dict[str, Any]:
+        """Fetch prices from the World App API and cache the result under key"""
         # Convert our token names to World App API token names
         api_crypto_currencies = [WORLD_API_TOKEN_MAPPING.get(token, token) for token in crypto_currencies]
         crypto_str = ",".join(api_crypto_currencies)
         fiat_str = ",".join(fiat_currencies)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://app-backend.worldcoin.dev/public/v1/miniapps/prices",
-                params={
-                    "cryptoCurrencies": crypto_str,
-                    "fiatCurrencies": fiat_str
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Failed to get token prices: {response.text}")
-            
-            result = response.json()["result"]
+        client = _get_http_client()
+        response = await client.get(
+            f"https://app-backend.worldcoin.dev/public/v1/miniapps/prices",
+            params={
+                "cryptoCurrencies": crypto_str,
+                "fiatCurrencies": fiat_str
+            }
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"Failed to get token prices: {response.text}")
+        
+        result = orjson.loads(response.content)["result"]
+        
+        # Convert World App API token names back to our internal token names in the response
+        if "prices" in result:
+            prices = {}
+            for api_token, token_data in result["prices"].items():
+                # Map from API token name back to our internal token name
+                prices[API_TO_INTERNAL_TOKEN.get(api_token, api_token)] = token_data
             
-            # Convert World App API token names back to our internal token names in the response
-            if "prices" in result:
-                prices = {}
-                for api_token, token_data in result["prices"].items():
-                    # Map from API token name back to our internal token name
-                    internal_token = next((our_token for our_token, api_name in WORLD_API_TOKEN_MAPPING.items() 
-                                          if api_name == api_token), api_token)
-                    prices[internal_token] = token_data
-                
-                result["prices"] = prices
-                
-            return result
+            result["prices"] = prices
+        
+        if len(_price_cache) >= TOKEN_PRICE_CACHE_MAX_SIZE:
+            _price_cache.pop(next(iter(_price_cache)), None)
+        _price_cache[key] = {"data": result, "expires": time.monotonic() + TOKEN_PRICE_CACHE_TTL_SECONDS}
+        return result
     
     @staticmethod
-    def token_to_decimals(amount: float, token: str) -> int:
+    def token_to_decimals(amount: Union[Decimal, str, float], token: str) -> int:
         """
         Convert token amount to decimals for payment.
         
+        The scaling is done in Decimal: a float times 10**18 (WLD) has more
+        digits than float64 can hold and comes out slightly off.
+        
         Args:
             amount: Amount in expected format (e.g., 25.12 for $25.12)
             token: Token type (USDC.e or WLD)
@@ -83,15 +172,17 @@ class PaymentService:
         Returns:
             Integer amount with proper decimal places
         """
-        if token not in TOKEN_DECIMALS:
+        try:
+            factor = TOKEN_FACTORS[token]
+        except KeyError:
             raise ValueError(f"Invalid token: {token}")
-            
-        decimals = TOKEN_DECIMALS[token]
-        factor = 10 ** decimals
         
-        # Round to nearest integer instead of requiring a whole number
-        # This handles fractional amounts that are common in crypto transactions
-        return int(round(amount * factor))
+        # Round to nearest integer (half to even, like round()) instead of
+        # requiring a whole number; this handles fractional amounts that are
+        # common in crypto transactions. str() gives a float's shortest
+        # decimal form, so 0.07 scales as 0.07 rather than 0.07000000000000000666
+        scaled = (amount if isinstance(amount, Decimal) else Decimal(str(amount))) * factor
+        return int(scaled.to_integral_value(rounding=ROUND_HALF_EVEN))
     
     @staticmethod
     def decimals_to_token(amount: int, token: str) -> float:
@@ -105,13 +196,12 @@ class PaymentService:
         Returns:
             Float amount in human-readable format
         """
-        if token not in TOKEN_DECIMALS:
+        try:
+            factor = TOKEN_FACTORS[token]
+        except KeyError:
             raise ValueError(f"Invalid token: {token}")
-            
-        decimals = TOKEN_DECIMALS[token]
-        factor = 10 ** decimals
         
-        return amount / factor
+        return float(Decimal(amount) / factor)
     
     @staticmethod
     async def calculate_token_amount(credits: int, token_type: str) -> Tuple[float, int]:
@@ -125,64 +215,71 @@ class PaymentService:
         Returns:
             Tuple of (human_readable_amount, raw_token_amount)
         """
-        # Direct WLD pricing: 0.1 WLD for 10 credits (0.01 WLD per credit)
-        wld_per_credit = 0.01  # 0.1 WLD for 10 credits
-        
         if token_type == "WLD":
-            # Direct calculation for WLD
-            token_amount = wld_per_credit * credits
+            # Direct calculation for WLD, exact in Decimal
+            token_amount = Decimal("0.01") * credits
             raw_amount = PaymentService.token_to_decimals(token_amount, token_type)
-            return (token_amount, raw_amount)
+            return (float(token_amount), raw_amount)
         else:
             # For other tokens, convert based on relative price to WLD
             try:
-                # Map to API token name
-                api_token = WORLD_API_TOKEN_MAPPING.get(token_type, token_type)
-                
-                # Get prices for both tokens
-                tokens_to_fetch = ["WLD", token_type]
-                prices = await PaymentService.get_token_prices(tokens_to_fetch, ["USD"])
-                
-                print(f"Token price API response: {prices}")
-                
-                # Get WLD price in USD
-                wld_price_data = prices["prices"]["WLD"]["USD"]
-                wld_price_raw = int(wld_price_data["amount"])
-                wld_decimals = int(wld_price_data["decimals"])
-                wld_price_usd = wld_price_raw / (10 ** wld_decimals)
-                
-                # Get selected token price in USD
-                if token_type not in prices["prices"]:
-                    # If our internal token name is not in response, try the API token name
-                    if api_token in prices["prices"]:
-                        token_price_data = prices["prices"][api_token]["USD"]
-                    else:
-                        raise ValueError(f"Token price data not found for {token_type} or {api_token}")
+                cached = _rate_cache.get(token_type)
+                if cached is not None and cached["expires"] > time.monotonic():
+                    token_per_credit = cached["data"]
                 else:
-                    token_price_data = prices["prices"][token_type]["USD"]
-                
-                token_price_raw = int(token_price_data["amount"])
-                token_decimals = int(token_price_data["decimals"])
-                token_price_usd = token_price_raw / (10 ** token_decimals)
-                
-                # Calculate the token amount using WLD as benchmark
-                # First get how much WLD would be needed
-                wld_amount = wld_per_credit * credits
+                    token_per_credit = await PaymentService._token_per_credit(token_type)
                 
-                # Then convert to equivalent amount in the other token
-                # Conversion rate = (token price in USD) / (WLD price in USD)
-                token_amount = wld_amount * (wld_price_usd / token_price_usd)
+                token_amount = credits * token_per_credit
                 
                 # Convert to token with decimals
                 raw_amount = PaymentService.token_to_decimals(token_amount, token_type)
                 
                 return (token_amount, raw_amount)
-            except Exception as e:
-                print(f"Error calculating token amount: {str(e)}")
+            except Exception:
+                logger.exception("Error calculating token amount")
                 raise
     
     @staticmethod
-    def initiate_payment(
+    async def _token_per_credit(token_type: str) -> float:
+        """Work out how much of token_type one credit costs and cache it"""
+        # Map to API token name
+        api_token = WORLD_API_TOKEN_MAPPING.get(token_type, token_type)
+        
+        # Get prices for both tokens
+        tokens_to_fetch = ["WLD", token_type]
+        prices = await PaymentService.get_token_prices(tokens_to_fetch, ["USD"])
+        
+        logger.debug("Token price API response: %s", prices)
+        
+        # Get WLD price in USD
+        wld_price_data = prices["prices"]["WLD"]["USD"]
+        wld_price_raw = int(wld_price_data["amount"])
+        wld_decimals = int(wld_price_data["decimals"])
+        wld_price_usd = wld_price_raw / (10 ** wld_decimals)
+        
+        # Get selected token price in USD
+        if token_type not in prices["prices"]:
+            # If our internal token name is not in response, try the API token name
+            if api_token in prices["prices"]:
+                token_price_data = prices["prices"][api_token]["USD"]
+            else:
+                raise ValueError(f"Token price data not found for {token_type} or {api_token}")
+        else:
+            token_price_data = prices["prices"][token_type]["USD"]
+        
+        token_price_raw = int(token_price_data["amount"])
+        token_decimals = int(token_price_data["decimals"])
+        token_price_usd = token_price_raw / (10 ** token_decimals)
+        
+        # Price one credit in WLD, then convert to the other token
+        # Conversion rate = (WLD price in USD) / (token price in USD)
+        token_per_credit = WLD_PER_CREDIT * (wld_price_usd / token_price_usd)
+        
+        _rate_cache[token_type] = {"data": token_per_credit, "expires": time.monotonic() + TOKEN_PRICE_CACHE_TTL_SECONDS}
+        return token_per_credit
+    
+    @staticmethod
+    async def initiate_payment(
         user_id: int, 
         credits: int, 
         token_type: str = DEFAULT_TOKEN
@@ -208,19 +305,20 @@ class PaymentService:
         reference = secrets.token_hex(16)
         
         # Use repository to create payment record
-        PaymentRepository.create_payment(
+        await _db(
+            PaymentRepository.create_payment,
             user_id=user_id,
             reference=reference,
             credits_amount=credits,
             token_type=token_type,
             token_decimal_places=TOKEN_DECIMALS[token_type],
-            recipient_address=os.getenv("PAYMENT_RECIPIENT_ADDRESS")
+            recipient_address=PAYMENT_RECIPIENT_ADDRESS
         )
         
         # Return payment details
         return {
             "reference": reference,
-            "recipient": os.getenv("PAYMENT_RECIPIENT_ADDRESS"),
+            "recipient": PAYMENT_RECIPIENT_ADDRESS,
             "credits_amount": credits,
             "token_type": token_type
         }
@@ -240,43 +338,47 @@ class PaymentService:
         Returns:
             Dictionary with verification results
         """
-        # Add debug logging
-        print(f"Transaction payload received: {transaction_payload}")
-        
-        # Get payment record using repository
-        payment = PaymentRepository.get_payment_by_reference(reference)
+        logger.debug("Transaction payload received: %s", transaction_payload)
         
-        if not payment:
-            raise ValueError("Payment not found")
-            
-        if payment.status == "confirmed":
-            raise ValueError("Payment already confirmed")
-            
-        # Get transaction ID from payload
+        # The World ID API lookup only needs the transaction ID from the
+        # payload, so start it now and let it overlap the payment lookup
         transaction_id = transaction_payload.get("transaction_id")
-        if not transaction_id:
-            print("ERROR: Missing transaction_id in payload!")
-            raise ValueError("Missing transaction ID in payload")
-        
-        # Verify with World ID API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
+        api_request = None
+        if transaction_id:
+            client = _get_http_client()
+            api_request = asyncio.ensure_future(client.get(
                 f"https://developer.worldcoin.org/api/v2/minikit/transaction/{transaction_id}",
-                params={
-                    "app_id": os.getenv("WORLD_ID_APP_ID"),
-                    "type": "payment"
-                },
-                headers={
-                    "Authorization": f"Bearer {os.getenv('DEV_PORTAL_API_KEY')}"
-                }
-            )
+                params=_TX_PARAMS,
+                headers=_AUTH_HEADERS
+            ))
+        
+        try:
+            # Get payment record using repository
+            payment = await _db(PaymentRepository.get_payment_by_reference, reference)
             
-            if response.status_code != 200:
-                raise Exception(f"Failed to verify transaction: {response.text}")
+            if not payment:
+                raise ValueError("Payment not found")
                 
-            transaction = response.json()
-            print(f"API response for transaction: {transaction}")
+            if payment.status == "confirmed":
+                raise ValueError("Payment already confirmed")
+                
+            if not transaction_id:
+                logger.error("Missing transaction_id in payload for payment %s", reference)
+                raise ValueError("Missing transaction ID in payload")
+        except BaseException:
+            if api_request is not None:
+                api_request.cancel()
+            raise
+        
+        # Verify with World ID API
+        response = await api_request
         
+        if response.status_code != 200:
+            raise Exception(f"Failed to verify transaction: {response.text}")
+            
+        transaction = orjson.loads(response.content)
+        logger.debug("API response for transaction: %s", transaction)
+
         # Verify transaction details
         if transaction.get("reference") != reference:
             raise ValueError("Transaction reference mismatch")
@@ -287,10 +389,10 @@ class PaymentService:
         
         # If API doesn't provide status, we can't proceed with payment
         if transaction_status is None:
-            print(f"WARNING: API didn't return a transaction status. Cannot verify payment.")
+            logger.warning("API didn't return a transaction status for payment %s. Cannot verify payment.", reference)
             return {"success": False, "status": "unverified", "message": "Could not verify transaction status with payment provider"}
         
-        print(f"Transaction status from API: {transaction_status}")
+        logger.debug("Transaction status from API: %s", transaction_status)
         
         # Prepare transaction details
         transaction_details = {
@@ -304,15 +406,19 @@ class PaymentService:
         
         if transaction_status == "failed":
             # Update payment status to failed
-            PaymentRepository.update_payment_status(
-                reference=reference, 
+            await _db(
+                PaymentRepository.update_payment_status,
+                reference=reference,
                 status="failed",
                 transaction_details=transaction_details
             )
             return {"success": False, "status": "failed"}
         
-        # Update payment with transaction details
-        PaymentRepository.update_payment_status(
+        # Update payment with transaction details. This must land before
+        # credits are added: if it fails, the payment isn't marked confirmed
+        # and a retry would otherwise credit the user twice
+        await _db(
+            PaymentRepository.update_payment_status,
             reference=reference,
             status="pending" if transaction_status == "pending" else "confirmed",
             transaction_details=transaction_details
@@ -320,21 +426,22 @@ class PaymentService:
         
         # If transaction status is success or confirmed, add credits to user
         if transaction_status in ["success", "confirmed", "mined", "pending"]:
-            print(f"Adding {payment.credits_amount} credits to user {payment.user_id}")
-            user = PaymentRepository.add_credits_to_user(
+            logger.info("Adding %d credits to user %d", payment.credits_amount, payment.user_id)
+            user = await _db(
+                PaymentRepository.add_credits_to_user,
                 user_id=payment.user_id,
                 credits=payment.credits_amount
             )
             
             if user:
-                print(f"User credits updated. New balance: {user.credits}")
+                logger.info("User credits updated. New balance: %d", user.credits)
                 return {
                     "success": True, 
                     "status": "confirmed", 
                     "credits": user.credits
                 }
             else:
-                print(f"Failed to update user credits!")
+                logger.error("Failed to update credits for user %d", payment.user_id)
         
         # Still pending
         return {"success": True, "status": "pending"}
@@ -351,7 +458,7 @@ class PaymentService:
             Dictionary with transaction status
         """
         # Get payment using repository
-        payment = PaymentRepository.get_payment_by_reference(reference)
+        payment = await _db(PaymentRepository.get_payment_by_reference, reference)
         
         if not payment:
             raise ValueError("Payment not found")
@@ -361,7 +468,7 @@ class PaymentService:
             
         # If payment already confirmed, no need to check API
         if payment.status == "confirmed":
-            credits = PaymentRepository.get_user_credits(payment.user_id)
+            credits = await _db(PaymentRepository.get_user_credits, payment.user_id)
             return {
                 "success": True,
                 "status": "confirmed",
@@ -378,23 +485,18 @@ class PaymentService:
             }
         
         # For pending payments, check latest status
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://developer.worldcoin.org/api/v2/minikit/transaction/{payment.transaction_id}",
-                params={
-                    "app_id": os.getenv("WORLD_ID_APP_ID"),
-                    "type": "payment"
-                },
-                headers={
-                    "Authorization": f"Bearer {os.getenv('DEV_PORTAL_API_KEY')}"
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Failed to get transaction status: {response.text}")
-                
-            transaction = response.json()
+        client = _get_http_client()
+        response = await client.get(
+            f"https://developer.worldcoin.org/api/v2/minikit/transaction/{payment.transaction_id}",
+            params=_TX_PARAMS,
+            headers=_AUTH_HEADERS
+        )
         
+        if response.status_code != 200:
+            raise Exception(f"Failed to get transaction status: {response.text}")
+            
+        transaction = orjson.loads(response.content)
+
         # Get transaction status
         transaction_status = transaction.get("transactionStatus")
         
@@ -405,8 +507,9 @@ class PaymentService:
         
         if transaction_status == "failed":
             # Update payment status to failed
-            PaymentRepository.update_payment_status(
-                reference=reference, 
+            await _db(
+                PaymentRepository.update_payment_status,
+                reference=reference,
                 status="failed",
                 transaction_details=transaction_details
             )
@@ -414,14 +517,16 @@ class PaymentService:
             
         if transaction_status in ["mined", "submitted"] and payment.status != "confirmed":
             # Update payment status to confirmed
-            PaymentRepository.update_payment_status(
-                reference=reference, 
+            await _db(
+                PaymentRepository.update_payment_status,
+                reference=reference,
                 status="confirmed",
                 transaction_details=transaction_details
             )
             
             # Add credits to user
-            user = PaymentRepository.add_credits_to_user(
+            user = await _db(
+                PaymentRepository.add_credits_to_user,
                 user_id=payment.user_id,
                 credits=payment.credits_amount
             )
@@ -438,7 +543,7 @@ class PaymentService:
         return {"success": True, "status": "pending", "reference": reference}
         
     @staticmethod
-    def get_user_payments(user_id: int, status: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def get_user_payments(user_id: int, status: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         Get all payments for a user, optionally filtered by status
         
@@ -449,7 +554,7 @@ class PaymentService:
         Returns:
             List of payment records
         """
-        payments = PaymentRepository.get_user_payments(user_id, status)
+        payments = await _db(PaymentRepository.get_user_payments, user_id, status)
         
         # Convert to dictionaries
         return [
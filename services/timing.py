@@ -224,7 +224,7 @@ def time_db_operation(func):
                 request.state.timing.add_db_time(db_time)
             else:
                 # Log but continue if no request or timing available
-                logger.debug(f"DB operation timed: {func.__name__} took {db_time:.4f}s (no request context)")
+                logger.debug("DB operation timed: %s took %.4fs (no request context)", func.__name__, db_time)
             
             return result
         return async_wrapper
@@ -245,7 +245,7 @@ def time_db_operation(func):
                 request.state.timing.add_db_time(db_time)
             else:
                 # Log but continue if no request or timing available
-                logger.debug(f"DB operation timed: {func.__name__} took {db_time:.4f}s (no request context)")
+                logger.debug("DB operation timed: %s took %.4fs (no request context)", func.__name__, db_time)
             
             return result
         return sync_wrapper
@@ -312,7 +312,7 @@ def time_network_operation(func):
                 request.state.timing.add_network_time(network_time)
             else:
                 # Log but continue if no request or timing available
-                logger.debug(f"Network operation timed: {func.__name__} took {network_time:.4f}s (no request context)")
+                logger.debug("Network operation timed: %s took %.4fs (no request context)", func.__name__, network_time)
             
             return result
         return async_wrapper
@@ -333,7 +333,7 @@ def time_network_operation(func):
                 request.state.timing.add_network_time(network_time)
             else:
                 # Log but continue if no request or timing available
-                logger.debug(f"Network operation timed: {func.__name__} took {network_time:.4f}s (no request context)")
+                logger.debug("Network operation timed: %s took %.4fs (no request context)", func.__name__, network_time)
             
             return result
         return sync_wrapper 
\ No newline at end of file
@@ -1,5 +1,6 @@
 from typing import Optional, Dict, List
 from sqlalchemy.orm import Session
+from sqlalchemy import func
 from repositories.user_repository import UserRepository
 from repositories.character_repository import CharacterRepository
 from database.models import User
@@ -111,9 +112,6 @@ class UserService:
             A dictionary where keys are language codes and values are the count of users.
             Example: {'en': 120, 'es': 45, 'fr': 22, ...}
         """
-        from sqlalchemy import func
-        from database.models import User
-        
         # Query to count users grouped by language
         result = db.query(
             User.language,
@@ -0,0 +1,25 @@
+import logging
+from routes.user_routes import router, parse_accept_language
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def test_routes_registered_once():
+    """Each user route (path + method) should only be registered once"""
+    signatures = [
+        (route.path, method)
+        for route in router.routes
+        for method in sorted(route.methods)
+    ]
+    logger.info(f"User routes: {signatures}")
+
+    assert len(set(signatures)) == len(signatures)
+
+def test_parse_accept_language():
+    """Single-token fast path and the full parser agree on the language code"""
+    assert parse_accept_language("") == "en"
+    assert parse_accept_language("es") == "es"
+    assert parse_accept_language("en-US") == "en"
+    assert parse_accept_language("en-US,en;q=0.9,es;q=0.8") == "en"
+    assert parse_accept_language("fr;q=0.5,de") == "de"